@@ -1,14 +1,17 @@
-from selenium import webdriver
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
 import json
 import fire
 import requests
 from bs4 import BeautifulSoup
-from time import sleep
 from abc import abstractmethod
 
+from driver_pool import DriverPool
+from fetcher import iter_pages
+from frontier import CrawlFrontier
+
 
 class PagesCrawler:
     """
@@ -29,14 +32,21 @@ class PagesCrawler:
     def page_process(self, url):
         raise ValueError("Implement me!")
 
-    def urls_crawling(self, urls):
+    def urls_crawling(self, urls, frontier: CrawlFrontier = None, retry_failed: bool = True):
+        """
+        frontier: crawl state, pages it has as visited are not requested
+        again; retry_failed: request its failed pages again.
+        """
         self.setup()
-        hrefs = {}
-        for url in urls:
+        frontier = frontier or CrawlFrontier()
+        frontier.add(urls)
+        for url in frontier.to_crawl(urls, retry_failed):
             try:
-                d = self.page_process(url)
-            except:
-                d = {}
+                frontier.mark_visited(url, self.page_process(url))
+            except Exception as e:
+                frontier.mark_failed(url, e)
+        hrefs = {}
+        for d in frontier.get_results(urls):
             for key in d:
                 if key not in hrefs:
                     hrefs[key] = []
@@ -56,24 +66,27 @@ class MosRuCrawler(PagesCrawler):
     """
     def __init__(
             self, web_resource_name: str = "https://www.mos.ru", output_name: str = "mos_ru_pages.json",
-            urls_count: int = 68_500, urls_per_page: int = 10
+            urls_count: int = 68_500, urls_per_page: int = 10, n_drivers: int = 4
     ):
         super().__init__(web_resource_name, output_name)
         self.urls_count = urls_count
         self.urls_per_page = urls_per_page
         self.pages = self.urls_count // self.urls_per_page
+        self.n_drivers = n_drivers
 
     def setup(self):
-        self.executor_path = "./crawler/geckodriver/geckodriver"
-        self.driver = webdriver.Firefox(executable_path=self.executor_path)
-        self.wait = WebDriverWait(self.driver, 60)
+        self.pool = DriverPool(self.n_drivers)
 
-    def page_process(self, url):
+    def page_process(self, url, driver=None):
+        if driver is None:
+            with DriverPool(1) as pool:
+                return pool.run(lambda driver, url: self.page_process(url, driver), url)
         hrefs = {}
-        self.driver.get(url)
-        reg = self.wait.until(EC.element_to_be_clickable((By.XPATH, "//*[@class='sc-bwzfXH cZMssy']")))
-        urls = self.driver.find_elements(By.XPATH, "//*[@class='sc-VigVT bMaCOi']")
-        themes = self.driver.find_elements(By.XPATH,
+        driver.get(url)
+        reg = WebDriverWait(driver, 60).until(
+            EC.element_to_be_clickable((By.XPATH, "//*[@class='sc-bwzfXH cZMssy']")))
+        urls = driver.find_elements(By.XPATH, "//*[@class='sc-VigVT bMaCOi']")
+        themes = driver.find_elements(By.XPATH,
                                       "//*[@class='Breadcrumbs-result__Item ListItem Breadcrumbs-result__Item--last']")
         if len(urls) != len(themes):
             raise ValueError("Parse Error!")
@@ -85,14 +98,17 @@ class MosRuCrawler(PagesCrawler):
             hrefs[theme].append(url)
         return hrefs
 
-    def urls_crawling(self, urls = []):
+    def urls_crawling(self, urls = [], frontier: CrawlFrontier = None, retry_failed: bool = True):
         hrefs = {}
-        for i in range(1, self.pages + 1):
-            url = f"https://www.mos.ru/search?category=newsfeed&page={i}&q="
-            try:
-                d = self.page_process(url)
-            except:
-                d = {}
+        frontier = frontier or CrawlFrontier()
+        # search pages are split across the browsers of the pool
+        page_urls = [f"https://www.mos.ru/search?category=newsfeed&page={i}&q="
+                     for i in range(1, self.pages + 1)]
+        frontier.add(page_urls)
+        with self.pool:
+            self.pool.map(lambda driver, url: frontier.mark_visited(url, self.page_process(url, driver)),
+                          frontier.to_crawl(page_urls, retry_failed), on_error=frontier.mark_failed)
+        for d in frontier.get_results(page_urls):
             for key in d:
                 if key not in hrefs:
                     hrefs[key] = []
@@ -106,27 +122,32 @@ class RiaNovostiCrawler(PagesCrawler):
     """
     Ria.ru crawling util. Crawling news from ria novosti
     """
-    def __init__(self, web_resource_name: str = "https://ria.ru/", output_name: str = "ria_ru_pages.json"):
+    def __init__(self, web_resource_name: str = "https://ria.ru/", output_name: str = "ria_ru_pages.json",
+                 n_drivers: int = 4):
         super().__init__(web_resource_name, output_name)
+        self.n_drivers = n_drivers
 
     def setup(self):
-        self.executor_path = "./crawler/geckodriver/geckodriver"
-        self.driver = webdriver.Firefox(executable_path=self.executor_path)
-        self.wait = WebDriverWait(self.driver, 60)
+        self.pool = DriverPool(self.n_drivers)
         self.spheres = (
             "space", "sn_health", "economy", "society", "incidents",
             "defense_safety", "science", "culture", "religion",
         )
         self.scroll_count = 100
-
-    def page_process(self, url):
-        self.driver.get(url)
+        self.scroll_timeout = 10
+
+    def page_process(self, url, driver=None):
+        if driver is None:
+            with DriverPool(1) as pool:
+                return pool.run(lambda driver, url: self.page_process(url, driver), url)
+        driver.get(url)
+        news_xpath = "//*[@class='list-item__title color-font-hover-only']"
         hrefs = set()
         current_news_list = set()
         for i in range(self.scroll_count):
-            reg = self.wait.until(
-                EC.element_to_be_clickable((By.XPATH, "//*[@class='list-item__title color-font-hover-only']")))
-            all_news_list = self.driver.find_elements(By.XPATH, "//*[@class='list-item__title color-font-hover-only']")
+            reg = WebDriverWait(driver, 60).until(
+                EC.element_to_be_clickable((By.XPATH, news_xpath)))
+            all_news_list = driver.find_elements(By.XPATH, news_xpath)
             all_news_list = set(all_news_list)
             news_list = all_news_list ^ current_news_list
             current_news_list = all_news_list
@@ -136,21 +157,32 @@ class RiaNovostiCrawler(PagesCrawler):
                     hrefs.add(href)
             try:
                 #  scroll
-                next_page = self.driver.find_element(By.XPATH, "//*[@class='list-more']")
+                next_page = driver.find_element(By.XPATH, "//*[@class='list-more']")
                 next_page.click()
             except:
-                self.driver.execute_script("window.scrollTo(0, document.body.scrollHeight)")
-            sleep(0.5)
+                driver.execute_script("window.scrollTo(0, document.body.scrollHeight)")
+            # wait for the next news instead of a fixed pause, none means the end
+            try:
+                WebDriverWait(driver, self.scroll_timeout).until(
+                    lambda d: len(d.find_elements(By.XPATH, news_xpath)) > len(all_news_list))
+            except TimeoutException:
+                break
         return hrefs
 
-    def urls_crawling(self, urls=[]):
+    def urls_crawling(self, urls=[], frontier: CrawlFrontier = None, retry_failed: bool = True):
+        frontier = frontier or CrawlFrontier()
+        # spheres are scrolled in parallel, one browser each
+        sphere_urls = [self.web_resource + sphere + "/" for sphere in self.spheres]
+        frontier.add(sphere_urls)
+        with self.pool:
+            self.pool.map(lambda driver, url: frontier.mark_visited(url, list(self.page_process(url, driver))),
+                          frontier.to_crawl(sphere_urls, retry_failed), on_error=frontier.mark_failed)
         hrefs_dict = {}
-        for sphere in self.spheres:
-            sphere_url = self.web_resource + sphere + "/"
-            hrefs = self.page_process(sphere_url)
-            hrefs_dict[sphere] = list(hrefs)
+        for sphere, sphere_url in zip(self.spheres, sphere_urls):
+            if sphere_url in frontier.results:
+                hrefs_dict[sphere] = frontier.results[sphere_url]
 
-        return hrefs_list
+        return hrefs_dict
 
 
 class PanoramaCrawler(PagesCrawler):
@@ -160,16 +192,25 @@ class PanoramaCrawler(PagesCrawler):
     def __init__(self, web_resource_name: str = "https://panorama.pub", output_name: str = "panorama_pages.json"):
         super().__init__(web_resource_name, output_name)
 
-    def urls_crawling(self, urls=[]):
+    def urls_crawling(self, urls=[], frontier: CrawlFrontier = None, retry_failed: bool = True):
         url_list = []
+        frontier = frontier or CrawlFrontier()
 
-        for i in range(1, 5):
-            url = "https://panorama.pub/news?page={}".format(i)
-            url_list.extend(self.page_process(url))
+        page_urls = ["https://panorama.pub/news?page={}".format(i) for i in range(1, 5)]
+        frontier.add(page_urls)
+        for url, page in iter_pages(frontier.to_crawl(page_urls, retry_failed)):
+            try:
+                if page is None:
+                    raise ConnectionError(f"Fetching {url} failed")
+                frontier.mark_visited(url, self.page_process(url, page))
+            except Exception as e:
+                frontier.mark_failed(url, e)
+        for page_hrefs in frontier.get_results(page_urls):
+            url_list.extend(page_hrefs)
         return url_list
 
-    def page_process(self, url):
-        page = requests.get(url)
+    def page_process(self, url, page=None):
+        page = page if page is not None else requests.get(url)
         soup = BeautifulSoup(page.text, 'html.parser')
         urls = []
 
@@ -0,0 +1,132 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+GECKODRIVER_PATH = "./crawler/geckodriver/geckodriver"
+
+
+def get_firefox_options(headless: bool = True,
+                        block_resources: bool = True) -> webdriver.FirefoxOptions:
+    """
+    headless Firefox, images, stylesheets and web fonts are not loaded:
+    the crawlers only read links and text of the DOM.
+    """
+    options = webdriver.FirefoxOptions()
+    if headless:
+        options.add_argument("-headless")
+    if block_resources:
+        options.set_preference("permissions.default.image", 2)
+        options.set_preference("permissions.default.stylesheet", 2)
+        options.set_preference("browser.display.use_document_fonts", 0)
+        options.set_preference("gfx.downloadable_fonts.enabled", False)
+        options.set_preference("media.autoplay.default", 5)
+    return options
+
+
+def is_alive(driver) -> bool:
+    try:
+        driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+class DriverPool:
+    """
+    Pool of headless Firefox drivers. map runs func(driver, item) for the
+    items on `size` browsers at once, each browser serves one item at a
+    time. A driver that crashed (the session no longer answers) is
+    replaced and its item retried up to max_restarts times; page errors
+    and timeouts of a live driver are raised to the caller.
+    """
+    def __init__(self, size: int = 4,
+                 executable_path: str = GECKODRIVER_PATH,
+                 page_load_timeout: float = 60,
+                 headless: bool = True,
+                 block_resources: bool = True,
+                 max_restarts: int = 2):
+        self.size = size
+        self.executable_path = executable_path
+        self.page_load_timeout = page_load_timeout
+        self.headless = headless
+        self.block_resources = block_resources
+        self.max_restarts = max_restarts
+        self.drivers = queue.Queue()
+        self.all_drivers = []
+        self.lock = threading.Lock()
+        self.restarts = 0
+        # drivers are started lazily, by the first items
+        for _ in range(size):
+            self.drivers.put(None)
+
+    def create_driver(self):
+        driver = webdriver.Firefox(executable_path=self.executable_path,
+                                   options=get_firefox_options(self.headless,
+                                                               self.block_resources))
+        driver.set_page_load_timeout(self.page_load_timeout)
+        with self.lock:
+            self.all_drivers.append(driver)
+        return driver
+
+    def quit_driver(self, driver) -> None:
+        with self.lock:
+            if driver in self.all_drivers:
+                self.all_drivers.remove(driver)
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+    def run(self, func: Callable, item):
+        driver = self.drivers.get()
+        try:
+            for restart in range(self.max_restarts + 1):
+                if driver is None:
+                    driver = self.create_driver()
+                try:
+                    return func(driver, item)
+                except TimeoutException:
+                    raise
+                except WebDriverException:
+                    if is_alive(driver) or restart == self.max_restarts:
+                        raise
+                    self.quit_driver(driver)
+                    driver = None
+                    with self.lock:
+                        self.restarts += 1
+        finally:
+            self.drivers.put(driver)
+
+    def map(self, func: Callable, items: Iterable,
+            on_error: Optional[Callable] = None) -> List:
+        """
+        Results in items order. on_error(item, exception) gives the result
+        of a failed item, the exception is raised when it is None.
+        """
+        def run_item(item):
+            try:
+                return self.run(func, item)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                return on_error(item, e)
+
+        with ThreadPoolExecutor(max_workers=self.size,
+                                thread_name_prefix='driver-pool') as executor:
+            return list(executor.map(run_item, items))
+
+    def close(self) -> None:
+        with self.lock:
+            drivers = list(self.all_drivers)
+        for driver in drivers:
+            self.quit_driver(driver)
+
+    def __enter__(self) -> 'DriverPool':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+import aiohttp
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class Page:
+    """
+    Fetched page with the requests.Response attributes the parsers read.
+    """
+    def __init__(self, url: str, status_code: int, content: bytes,
+                 encoding: Optional[str] = None, headers: Optional[dict] = None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+        self.headers = headers or dict()
+
+    def __repr__(self):
+        return f'Page(url={self.url}, status_code={self.status_code})'
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors='replace')
+
+
+class Fetcher:
+    """
+    Asyncio HTTP client of the crawlers and the parsers: one keep-alive
+    connection pool (max_connections in total, per_host per site), retries
+    with exponential backoff on connection errors, timeouts and 429 / 5xx
+    answers.
+    url_rewrite: maps the page url to the url actually requested, e.g.
+    SavedPagesServer.rewrite to crawl saved pages locally.
+    """
+    def __init__(self, max_connections: int = 64,
+                 per_host: int = 8,
+                 timeout: float = 30,
+                 retries: int = 3,
+                 backoff: float = 0.5,
+                 headers: Optional[dict] = None,
+                 url_rewrite: Optional[Callable[[str], str]] = None):
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = headers or {'User-Agent': 'Mozilla/5.0 (compatible; fake-news-crawler)'}
+        self.url_rewrite = url_rewrite
+        self.session = None
+
+    async def open(self) -> 'Fetcher':
+        connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                         limit_per_host=self.per_host)
+        self.session = aiohttp.ClientSession(
+            connector=connector, headers=self.headers,
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self) -> 'Fetcher':
+        return await self.open()
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def get_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), 60)
+        return self.backoff * 2 ** attempt * (1 + random.random())
+
+    async def fetch(self, url: str) -> Page:
+        """
+        Returns the page, an error status is returned as is once retries
+        are exhausted. Raises the last connection error or timeout.
+        """
+        request_url = self.url_rewrite(url) if self.url_rewrite is not None else url
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.get(request_url) as response:
+                    content = await response.read()
+                    if response.status in RETRY_STATUSES and attempt < self.retries:
+                        await asyncio.sleep(self.get_delay(
+                            attempt, response.headers.get('Retry-After')))
+                        continue
+                    return Page(url, response.status, content,
+                                response.charset, dict(response.headers))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self.get_delay(attempt))
+
+    async def fetch_or_none(self, url: str) -> Optional[Page]:
+        try:
+            return await self.fetch(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+
+def iter_pages(urls: Iterable[str], window: int = 256,
+               **fetcher_kwargs) -> Iterator[Tuple[str, Optional[Page]]]:
+    """
+    Fetches the urls on an event loop in a background thread and yields
+    (url, page) in urls order, page is None when fetching failed. At most
+    window pages are in flight or buffered, so synchronous consumers
+    (parsing) overlap with the downloads.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name='fetcher', daemon=True)
+    thread.start()
+    fetcher = Fetcher(**fetcher_kwargs)
+    asyncio.run_coroutine_threadsafe(fetcher.open(), loop).result()
+    pending = deque()
+    try:
+        for url in urls:
+            pending.append((url, asyncio.run_coroutine_threadsafe(
+                fetcher.fetch_or_none(url), loop)))
+            if len(pending) >= window:
+                url, future = pending.popleft()
+                yield url, future.result()
+        while pending:
+            url, future = pending.popleft()
+            yield url, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        asyncio.run_coroutine_threadsafe(fetcher.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def fetch_pages(urls: Iterable[str], **fetcher_kwargs) -> List[Optional[Page]]:
+    return [page for _, page in iter_pages(urls, **fetcher_kwargs)]
+
+
+def get_page_name(url: str) -> str:
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def save_pages(pages: Iterable[Page], directory: str) -> int:
+    """
+    Stores pages for SavedPagesServer: one file per page and an
+    index.jsonl line with its url, status and content type.
+    """
+    os.makedirs(directory, exist_ok=True)
+    n_pages = 0
+    with open(os.path.join(directory, 'index.jsonl'), 'at') as index:
+        for page in pages:
+            name = get_page_name(page.url)
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(page.content)
+            index.write(json.dumps({
+                'url': page.url, 'file': name, 'status': page.status_code,
+                'content_type': page.headers.get('Content-Type',
+                                                 f'text/html; charset={page.encoding}'),
+            }, ensure_ascii=False))
+            index.write('\n')
+            n_pages += 1
+    return n_pages
+
+
+class SavedPagesServer:
+    """
+    Local HTTP stand-in for the crawled sites serving the pages of
+    save_pages. Pass rewrite as the Fetcher url_rewrite: the original url
+    travels quoted in the request path.
+    """
+    def __init__(self, directory: str, host: str = '127.0.0.1', port: int = 0):
+        self.directory = directory
+        self.pages = dict()
+        with open(os.path.join(directory, 'index.jsonl'), 'rt') as f:
+            for line in f:
+                if line.strip():
+                    page = json.loads(line)
+                    self.pages[page['url']] = page
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, as the real sites
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests += 1
+                page = server.pages.get(unquote(self.path[1:]))
+                if page is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                with open(os.path.join(server.directory, page['file']), 'rb') as f:
+                    content = f.read()
+                self.send_response(page['status'])
+                self.send_header('Content-Type', page['content_type'])
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def rewrite(self, url: str) -> str:
+        return f"{self.url}/{quote(url, safe='')}"
+
+    def start(self) -> 'SavedPagesServer':
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='saved-pages', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> 'SavedPagesServer':
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main(urls_path: str, output: str, concurrency: int, per_host: int):
+    with open(urls_path, "rt") as f:
+        urls = json.load(f)
+    if isinstance(urls, dict):
+        urls = [url for values in urls.values() for url in values]
+    pages = (page for _, page in iter_pages(urls, max_connections=concurrency,
+                                            per_host=per_host)
+             if page is not None)
+    print(f'saved {save_pages(pages, output)} of {len(urls)} pages')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Saves pages for offline crawling")
+    parser.add_argument("--urls", type=str, required=True,
+                        help="path to json with a list or a dict of url lists")
+    parser.add_argument("--output", type=str, required=True,
+                        help="directory of the saved pages")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="connections in total")
+    parser.add_argument("--per-host", type=int, default=8,
+                        help="connections per site")
+
+    args = parser.parse_args()
+    main(urls_path=args.urls, output=args.output,
+         concurrency=args.concurrency, per_host=args.per_host)
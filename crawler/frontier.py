@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+PENDING = 'pending'
+VISITED = 'visited'
+FAILED = 'failed'
+
+
+class CrawlFrontier:
+    """
+    State of a crawl: pending, visited and failed pages, with the urls
+    found on the visited ones. Every change is an event line appended to a
+    JSON Lines log, buffered and flushed every flush_every events or
+    flush_interval seconds. Opening an existing log replays it, so a
+    restarted crawl skips the visited pages.
+    path=None keeps the state in memory only.
+    """
+    def __init__(self, path: Optional[str] = None,
+                 flush_every: int = 100,
+                 flush_interval: float = 5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.state = dict()
+        self.results = dict()
+        self.errors = dict()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.file = None
+        if path is not None:
+            if os.path.exists(path):
+                self.replay(path)
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, 'at')
+            if self.file.tell() and not self.ends_with_newline(path):
+                self.file.write('\n')
+
+    @staticmethod
+    def ends_with_newline(path: str) -> bool:
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def __repr__(self):
+        return f'CrawlFrontier(path={self.path}, {self.counts()})'
+
+    def replay(self, path: str) -> None:
+        with open(path, 'rt') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a crawl killed while writing
+                    continue
+                self.apply(event)
+
+    def apply(self, event: dict) -> None:
+        url = event['url']
+        self.state[url] = event['event']
+        if event['event'] == VISITED:
+            self.results[url] = event.get('result')
+            self.errors.pop(url, None)
+        elif event['event'] == FAILED:
+            self.errors[url] = event.get('error')
+
+    def log(self, event: dict) -> None:
+        with self.lock:
+            self.apply(event)
+            if self.file is None:
+                return
+            self.buffer.append(json.dumps(event, ensure_ascii=False))
+            if len(self.buffer) >= self.flush_every or \
+                    time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def add(self, urls: Iterable[str]) -> List[str]:
+        """
+        Registers urls to visit, returns the ones not seen before.
+        """
+        added = []
+        for url in urls:
+            if url not in self.state:
+                self.log({'event': PENDING, 'url': url})
+                added.append(url)
+        return added
+
+    def mark_visited(self, url: str, result: Any = None) -> None:
+        """
+        result: data extracted from the page (found urls), JSON serializable.
+        """
+        self.log({'event': VISITED, 'url': url, 'result': result})
+
+    def mark_failed(self, url: str, error: Union[BaseException, str, None] = None) -> None:
+        if isinstance(error, BaseException):
+            error = f'{type(error).__name__}: {error}'
+        self.log({'event': FAILED, 'url': url, 'error': error})
+
+    def to_crawl(self, urls: Optional[Iterable[str]] = None,
+                 retry_failed: bool = True) -> List[str]:
+        """
+        Pages of urls (all known by default) still to visit: pending ones
+        and, with retry_failed, the failed ones.
+        """
+        statuses = (PENDING, FAILED) if retry_failed else (PENDING,)
+        urls = self.state if urls is None else urls
+        return [url for url in urls if self.state.get(url) in statuses]
+
+    def get_results(self, urls: Iterable[str]) -> List[Any]:
+        """
+        Results of the visited pages among urls, in urls order.
+        """
+        return [self.results[url] for url in urls if self.state.get(url) == VISITED]
+
+    def counts(self) -> Dict[str, int]:
+        counts = {PENDING: 0, VISITED: 0, FAILED: 0}
+        for status in self.state.values():
+            counts[status] += 1
+        return counts
+
+    def _flush(self) -> None:
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self._flush()
+
+    def reset(self) -> None:
+        """
+        Forgets the logged state, the next crawl starts over.
+        """
+        with self.lock:
+            self.state.clear()
+            self.results.clear()
+            self.errors.clear()
+            self.buffer = []
+            if self.file is not None:
+                self.file.truncate(0)
+
+    def close(self) -> None:
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self) -> 'CrawlFrontier':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -1,17 +1,33 @@
+import os
+
 import fire
 
 from crawler import MosRuCrawler, RiaNovostiCrawler, PanoramaCrawler
+from frontier import CrawlFrontier
 
 
-def main():
-    mos_ru_crawler = MosRuCrawler()
-    ria_novosti_crawler = RiaNovostiCrawler()
+def main(n_drivers: int = 4, frontier_dir: str = "crawl_state",
+         resume: bool = True, retry_failed: bool = True):
+    """
+    n_drivers: headless browsers of the selenium crawlers.
+    frontier_dir: directory of the crawl state logs, one per crawler.
+    resume: continue the crawls logged in frontier_dir, skipping the
+    visited pages; otherwise start over.
+    retry_failed: request the pages failed in the previous runs again.
+    """
+    mos_ru_crawler = MosRuCrawler(n_drivers=n_drivers)
+    ria_novosti_crawler = RiaNovostiCrawler(n_drivers=n_drivers)
     panorama_crawler = PanoramaCrawler()
     crawlers = [mos_ru_crawler, ria_novosti_crawler, panorama_crawler]
     for crawl in crawlers:
-        crawl.setup()
-        pages = crawl.urls_crawling()
-        crawl.save(pages)
+        name = os.path.splitext(os.path.basename(crawl.output_name))[0]
+        with CrawlFrontier(os.path.join(frontier_dir, f"{name}.frontier.jsonl")) as frontier:
+            if not resume:
+                frontier.reset()
+            crawl.setup()
+            pages = crawl.urls_crawling(frontier=frontier, retry_failed=retry_failed)
+            crawl.save(pages)
+            print(frontier)
 
 
 if __name__ == "__main__":
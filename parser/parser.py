@@ -15,6 +15,7 @@ import stanza
 import json
 import pymorphy2
 
+from functools import lru_cache
 from time import sleep
 
 
@@ -24,6 +25,9 @@ class Parser:
         stanza.download('ru')
         self.nlp = stanza.Pipeline(lang='ru', processors='tokenize,ner')
         self.morph = pymorphy2.MorphAnalyzer()
+        # news repeat the same names, NER hits are lemmatized once
+        self.normal_form = lru_cache(maxsize=65536)(
+            lambda word: self.morph.parse(word)[0].normal_form)
         self.output_name = output_name
 
     def stanza_nlp_ru(self, text):
@@ -51,8 +55,16 @@ class Parser:
         with open(self.output_name, "wt") as f:
             json.dump(parsed_urls, f)
 
+    @staticmethod
+    def get_page(url: str, page=None):
+        """
+        page: already downloaded page (fetcher.Page or requests.Response),
+        the url is requested when it is None.
+        """
+        return page if page is not None else requests.get(url)
+
     @abstractmethod
-    def parse_page(self, url: str):
+    def parse_page(self, url: str, page=None):
         raise ValueError("Implement me!")
 
 
@@ -63,9 +75,9 @@ class MosRuParser(Parser):
     def __init__(self, output_name: str = "mos_ru_parsed.json"):
         super().__init__(output_name)
 
-    def parse_page(self, url: str):
+    def parse_page(self, url: str, page=None):
         try:
-            page = requests.get(url)
+            page = self.get_page(url, page)
             soup = BeautifulSoup(page.text, 'html.parser')
 
             info = {}
@@ -96,8 +108,7 @@ class MosRuParser(Parser):
                 info["base_links"] = list(set(base_links))
                 entities = []
                 for word in self.stanza_nlp_ru(info["text"]):
-                    p = self.morph.parse(word)[0]
-                    entities.append(p.normal_form)
+                    entities.append(self.normal_form(word))
 
                 info["entity"] = list(set(entities))
                 return info
@@ -112,9 +123,9 @@ class RiaRuParser(Parser):
     def __init__(self, output_name: str = "ria_ru_parsed.json"):
         super().__init__(output_name)
 
-    def parse_page(self, url: str):
+    def parse_page(self, url: str, page=None):
         try:
-            page = requests.get(url)
+            page = self.get_page(url, page)
             soup = BeautifulSoup(page.text, 'html.parser')
 
             info = {}
@@ -142,8 +153,7 @@ class RiaRuParser(Parser):
                 raw_entities = []
                 for word in self.stanza_nlp_ru(info["text"]):
                     raw_entities.append(word)
-                    p = self.morph.parse(word)[0]
-                    entities.append(p.normal_form)
+                    entities.append(self.normal_form(word))
 
                 info["entity"] = list(set(entities))
                 info["raw_entity"] = list(set(raw_entities))
@@ -177,9 +187,9 @@ class PanoramaParser(Parser):
                     info["title"] = i.attrib["content"]
         return info
 
-    def parse_page(self, url: str):
+    def parse_page(self, url: str, page=None):
         try:
-            page = requests.get(url)
+            page = self.get_page(url, page)
             soup = BeautifulSoup(page.text, 'html.parser')
 
             info = {}
@@ -206,8 +216,7 @@ class PanoramaParser(Parser):
                 entities = []
                 raw_entities = []
                 for word in self.stanza_nlp_ru(info["text"]):
-                    p = self.morph.parse(word)[0]
-                    entities.append(p.normal_form)
+                    entities.append(self.normal_form(word))
                     raw_entities.append(word)
 
                 info["entity"] = list(set(entities))
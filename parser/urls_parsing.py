@@ -1,16 +1,31 @@
 import argparse
 import json
+import os
+import sys
 from pandas.core.common import flatten
 from functools import wraps
 
 from multiprocessing.dummy import Pool as ThreadPool
 from multiprocessing.dummy import Lock, Value
 
+# the page fetcher is shared with the crawler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'crawler'))
+from fetcher import iter_pages, SavedPagesServer
 from parser import MosRuParser, RiaRuParser, PanoramaParser
 
 N_THREADS = 10
+FETCH_CONCURRENCY = 64
+FETCH_PER_HOST = 8
 
-def main(mos_ru_pages: str, ria_pages: str, panorama_pages: str):
+def main(mos_ru_pages: str, ria_pages: str, panorama_pages: str,
+         concurrency: int = FETCH_CONCURRENCY, per_host: int = FETCH_PER_HOST,
+         saved_pages: str = None):
+    """
+    Pages are downloaded by the async fetcher (pooled keep-alive
+    connections) while the thread pool parses the ones already there.
+    saved_pages: directory of fetcher.save_pages served locally instead of
+    the sites.
+    """
     mos_ru_parser = MosRuParser()
     ria_parser = RiaRuParser()
     panorama_parser = PanoramaParser()
@@ -26,11 +41,19 @@ def main(mos_ru_pages: str, ria_pages: str, panorama_pages: str):
     parse_perform = [
         (mos_ru_parser, mos_ru_urls), (ria_parser, ria_urls), (panorama_parser, panorama_urls)
     ]
-    for performer in parse_perform:
-        with ThreadPool(processes=N_THREADS) as pool:
-            res = pool.map(lambda x: parse(x, parser=performer[0]), performer[1])
-        pool.join()
-        performer[0].save(res)
+    server = SavedPagesServer(saved_pages).start() if saved_pages else None
+    try:
+        for performer in parse_perform:
+            pages = iter_pages(performer[1], max_connections=concurrency,
+                               per_host=per_host,
+                               url_rewrite=server.rewrite if server else None)
+            with ThreadPool(processes=N_THREADS) as pool:
+                res = list(pool.imap(lambda x: parse(*x, parser=performer[0]), pages))
+            pool.join()
+            performer[0].save(res)
+    finally:
+        if server is not None:
+            server.stop()
 
 
 def func_wrapper(func):
@@ -42,8 +65,11 @@ def func_wrapper(func):
 
 
 @func_wrapper
-def parse(url, parser):
-    return parser.parse_page(url)
+def parse(url, page, parser):
+    if page is None:
+        # download failed after retries
+        return {}
+    return parser.parse_page(url, page)
 
 
 if __name__ == "__main__":
@@ -54,6 +80,13 @@ if __name__ == "__main__":
                         help="path to json with ria.ru urls")
     parser.add_argument("--panorama_pages", type=str, required=True,
                         help="path to json with panorama urls")
+    parser.add_argument("--concurrency", type=int, default=FETCH_CONCURRENCY,
+                        help="connections in total")
+    parser.add_argument("--per-host", type=int, default=FETCH_PER_HOST,
+                        help="connections per site")
+    parser.add_argument("--saved-pages", type=str, default=None,
+                        help="directory of saved pages served locally instead of the sites")
 
     args = parser.parse_args()
-    main(mos_ru_pages=args.mos_ru_pages, ria_pages=args.ria_pages, panorama_pages=args.panorama_pages)
+    main(mos_ru_pages=args.mos_ru_pages, ria_pages=args.ria_pages, panorama_pages=args.panorama_pages,
+         concurrency=args.concurrency, per_host=args.per_host, saved_pages=args.saved_pages)
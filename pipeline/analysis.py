@@ -0,0 +1,105 @@
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set
+
+from search_utils import (
+    lemmatize_text, find_all_entities, EntityLocator, SentenceSpans
+)
+
+
+class DocumentAnalysis:
+    """
+    One article parsed once per request: stanza segmentation and NER run a
+    single time, entity lemmas, entity offsets and entity sentences are
+    cached and shared by the searchers and the scorer.
+    raw_entities: already extracted entities (index build), nlp is not
+    called then.
+    """
+    def __init__(self, text: str,
+                 lemmatizer=lemmatize_text,
+                 nlp=None,
+                 raw_entities: Optional[List[str]] = None):
+        self.text = text
+        self.lemmatizer = lemmatizer
+        self.nlp = nlp
+        self._doc = None
+        self._raw_entities = raw_entities
+        self._lemmas = dict()
+        self._entity_offsets = None
+        self._sentence_spans = None
+        self._entity_context = None
+        self._entity_frequency = None
+
+    @property
+    def doc(self):
+        """
+        stanza Document of the text.
+        """
+        if self._doc is None:
+            self._doc = self.nlp(self.text)
+        return self._doc
+
+    @property
+    def raw_entities(self) -> List[str]:
+        if self._raw_entities is None:
+            self._raw_entities = [ent.text for sentence in self.doc.sentences
+                                  for ent in sentence.ents]
+        return self._raw_entities
+
+    def lemmatize(self, raw_entity: str) -> str:
+        if raw_entity not in self._lemmas:
+            self._lemmas[raw_entity] = self.lemmatizer(raw_entity)
+        return self._lemmas[raw_entity]
+
+    @property
+    def entity_offsets(self) -> Dict[str, List[int]]:
+        """
+        Raw entity -> find_all_entities offsets, one automaton pass for all.
+        """
+        if self._entity_offsets is None:
+            self._entity_offsets = EntityLocator(self.raw_entities).find_all(self.text)
+        return self._entity_offsets
+
+    def find_entity(self, raw_entity: str) -> List[int]:
+        if raw_entity not in self.entity_offsets:
+            self._entity_offsets[raw_entity] = \
+                list(find_all_entities(self.text, raw_entity))
+        return self._entity_offsets[raw_entity]
+
+    @property
+    def sentence_spans(self) -> SentenceSpans:
+        """
+        Sentence table the entity contexts are cut from.
+        """
+        if self._sentence_spans is None:
+            self._sentence_spans = SentenceSpans(self.text)
+        return self._sentence_spans
+
+    def sentence_at(self, idx: int) -> str:
+        return self.sentence_spans.sentence_at(idx)
+
+    def _analyze_entities(self) -> None:
+        entity_context = defaultdict(set)
+        entity_frequency = defaultdict(int)
+        # every NER mention counts all occurrences of its text, as before
+        for raw_entity in self.raw_entities:
+            normalized_entity = self.lemmatize(raw_entity)
+            for entity_idx in self.find_entity(raw_entity):
+                entity_context[normalized_entity].add(self.sentence_at(entity_idx))
+                entity_frequency[normalized_entity] += 1
+        self._entity_context = entity_context
+        self._entity_frequency = Counter(entity_frequency)
+
+    @property
+    def entity_context(self) -> Dict[str, Set[str]]:
+        """
+        Normalized entity -> sentences of the text that mention it.
+        """
+        if self._entity_context is None:
+            self._analyze_entities()
+        return self._entity_context
+
+    @property
+    def entity_frequency(self) -> Counter:
+        if self._entity_frequency is None:
+            self._analyze_entities()
+        return self._entity_frequency
@@ -0,0 +1,294 @@
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+from typing import Optional, Tuple
+
+
+def get_norms(embeddings: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    norms = np.empty(len(embeddings), dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_size):
+        norms[start:start + chunk_size] = \
+            np.linalg.norm(embeddings[start:start + chunk_size], axis=1)
+    return np.maximum(norms, 1e-12)
+
+
+def read_meta(path: str, index_version: Optional[str]) -> dict:
+    """
+    Meta of a structure persisted at path, ValueError when it was built
+    for another version of the index.
+    """
+    with open(os.path.join(path, 'meta.json'), 'rt') as f:
+        meta = json.load(f)
+    if meta.get('index_version') != index_version:
+        raise ValueError(f"{meta['type']} structure at {path} was built for index "
+                         f"version {meta.get('index_version')}, expected {index_version}")
+    return meta
+
+
+def save_directory(path: str, write) -> None:
+    """
+    write(directory) fills a temporary directory that then replaces path,
+    so the workers of a server building the same structure at once never
+    read half written files.
+    """
+    tmp_path = f'{os.path.normpath(path)}.tmp-{uuid.uuid4().hex[:8]}'
+    os.makedirs(tmp_path)
+    try:
+        write(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # path exists: stale, or saved by another worker meanwhile
+            stale_path = f'{tmp_path}.stale'
+            try:
+                os.rename(path, stale_path)
+                os.rename(tmp_path, path)
+            except OSError:
+                # another worker replaced it first, its copy is as good
+                pass
+            shutil.rmtree(stale_path, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def top_k(scores: np.ndarray, k_top: int) -> np.ndarray:
+    """
+    Positions of the k_top highest scores, best first.
+    """
+    if k_top >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    best = np.argpartition(-scores, k_top - 1)[:k_top]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class ExactSearch:
+    """
+    Brute-force cosine similarity search over the whole corpus.
+    Reference for recall checks of the approximate backends.
+    """
+    def __init__(self, corpus_embeddings: np.ndarray):
+        self.corpus_embeddings = corpus_embeddings
+        self.norms = get_norms(corpus_embeddings)
+
+    def search(self, query_embedding: np.ndarray, k_top: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns corpus rows and cosine scores of the k_top best documents.
+        """
+        query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+        scores = self.corpus_embeddings @ query_embedding / self.norms
+        rows = top_k(scores, k_top)
+        return rows, scores[rows]
+
+
+class IVFSearch:
+    """
+    Inverted file index: corpus vectors are clustered with spherical k-means
+    and a query only scans the n_probe clusters closest to it.
+    n_lists / n_probe trade recall for latency.
+    """
+    def __init__(self, corpus_embeddings: np.ndarray,
+                 n_lists: int = None, n_probe: int = 8):
+        self.corpus_embeddings = corpus_embeddings
+        self.norms = get_norms(corpus_embeddings)
+        self.n_lists = n_lists or max(1, int(np.sqrt(len(corpus_embeddings))))
+        self.n_probe = n_probe
+        self.centroids = None
+        self.list_offsets = None
+        self.list_rows = None
+
+    def __repr__(self):
+        return f'IVFSearch(n_lists={self.n_lists}, n_probe={self.n_probe})'
+
+    def assign(self, chunk_size: int = 65536) -> np.ndarray:
+        assignment = np.empty(len(self.corpus_embeddings), dtype=np.int64)
+        for start in range(0, len(self.corpus_embeddings), chunk_size):
+            chunk = self.corpus_embeddings[start:start + chunk_size] / \
+                self.norms[start:start + chunk_size, None]
+            assignment[start:start + chunk_size] = \
+                np.argmax(chunk @ self.centroids.T, axis=1)
+        return assignment
+
+    def build(self, n_iter: int = 10, train_size: int = 50000,
+              seed: int = 0) -> 'IVFSearch':
+        rng = np.random.default_rng(seed)
+        n_documents = len(self.corpus_embeddings)
+        sample_rows = np.sort(rng.choice(n_documents, min(train_size, n_documents),
+                                         replace=False))
+        sample = self.corpus_embeddings[sample_rows] / self.norms[sample_rows, None]
+        self.n_lists = min(self.n_lists, len(sample))
+        self.centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)]
+        for _ in range(n_iter):
+            sample_assignment = np.argmax(sample @ self.centroids.T, axis=1)
+            for list_id in range(self.n_lists):
+                members = sample[sample_assignment == list_id]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    self.centroids[list_id] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        assignment = self.assign()
+        self.list_rows = np.argsort(assignment, kind='stable')
+        self.list_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(assignment, minlength=self.n_lists))])
+        return self
+
+    def search(self, query_embedding: np.ndarray, k_top: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+        probe = top_k(self.centroids @ query_embedding, self.n_probe)
+        rows = np.concatenate([self.list_rows[self.list_offsets[list_id]:
+                                              self.list_offsets[list_id + 1]]
+                               for list_id in probe])
+        scores = self.corpus_embeddings[rows] @ query_embedding / self.norms[rows]
+        best = top_k(scores, k_top)
+        return rows[best], scores[best]
+
+    def save(self, path: str, index_version: Optional[str] = None) -> None:
+        """
+        index_version: version of the index the corpus embeddings come from.
+        """
+        def write(directory):
+            np.save(os.path.join(directory, 'centroids.npy'), self.centroids)
+            np.save(os.path.join(directory, 'list_offsets.npy'), self.list_offsets)
+            np.save(os.path.join(directory, 'list_rows.npy'), self.list_rows)
+            with open(os.path.join(directory, 'meta.json'), 'wt') as f:
+                json.dump({'type': 'ivf', 'n_lists': self.n_lists,
+                           'documents': len(self.corpus_embeddings),
+                           'index_version': index_version}, f)
+
+        save_directory(path, write)
+
+    @classmethod
+    def load(cls, path: str, corpus_embeddings: np.ndarray,
+             n_probe: int = 8, index_version: Optional[str] = None) -> 'IVFSearch':
+        meta = read_meta(path, index_version)
+        if meta['documents'] != len(corpus_embeddings):
+            raise ValueError(f"IVF index at {path} was built for {meta['documents']} "
+                             f"documents, corpus has {len(corpus_embeddings)}")
+        ivf = cls(corpus_embeddings, meta['n_lists'], n_probe)
+        ivf.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        ivf.list_offsets = np.load(os.path.join(path, 'list_offsets.npy'))
+        ivf.list_rows = np.load(os.path.join(path, 'list_rows.npy'), mmap_mode='r')
+        return ivf
+
+
+class Int8Search:
+    """
+    Scalar int8 quantized copy of the normalized corpus embeddings, 4x
+    smaller than float32. A float query is scored against the int8 codes
+    (asymmetric distance), then the rerank_factor * k_top best rows are
+    re-ranked with the float embeddings. rerank_factor=0 disables it.
+    """
+    def __init__(self, corpus_embeddings: np.ndarray, rerank_factor: int = 4,
+                 chunk_size: int = 1024):
+        self.corpus_embeddings = corpus_embeddings
+        self.rerank_factor = rerank_factor
+        self.chunk_size = chunk_size
+        self.codes = None
+        self.scale = None
+
+    def __repr__(self):
+        return f'Int8Search(rerank_factor={self.rerank_factor})'
+
+    def build(self) -> 'Int8Search':
+        n_documents, dim = self.corpus_embeddings.shape
+        norms = get_norms(self.corpus_embeddings, self.chunk_size)
+        max_abs = np.zeros(dim, dtype=np.float32)
+        for start in range(0, n_documents, self.chunk_size):
+            chunk = self.corpus_embeddings[start:start + self.chunk_size] / \
+                norms[start:start + self.chunk_size, None]
+            max_abs = np.maximum(max_abs, np.abs(chunk).max(axis=0))
+        self.scale = (np.maximum(max_abs, 1e-12) / 127).astype(np.float32)
+        self.codes = np.empty((n_documents, dim), dtype=np.int8)
+        for start in range(0, n_documents, self.chunk_size):
+            chunk = self.corpus_embeddings[start:start + self.chunk_size] / \
+                norms[start:start + self.chunk_size, None]
+            self.codes[start:start + self.chunk_size] = \
+                np.clip(np.rint(chunk / self.scale), -127, 127)
+        return self
+
+    def search(self, query_embedding: np.ndarray, k_top: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+        scaled_query = (query_embedding * self.scale).astype(np.float32)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        # small chunks keep the float32 copy of the codes in cache
+        for start in range(0, len(self.codes), self.chunk_size):
+            scores[start:start + self.chunk_size] = \
+                self.codes[start:start + self.chunk_size].astype(np.float32) @ scaled_query
+        if not self.rerank_factor:
+            rows = top_k(scores, k_top)
+            return rows, scores[rows]
+        rows = np.sort(top_k(scores, k_top * self.rerank_factor))
+        candidates = np.asarray(self.corpus_embeddings[rows], dtype=np.float32)
+        scores = candidates @ query_embedding / \
+            np.maximum(np.linalg.norm(candidates, axis=1), 1e-12)
+        best = top_k(scores, k_top)
+        return rows[best], scores[best]
+
+    def save(self, path: str, index_version: Optional[str] = None) -> None:
+        def write(directory):
+            np.save(os.path.join(directory, 'codes.npy'), self.codes)
+            np.save(os.path.join(directory, 'scale.npy'), self.scale)
+            with open(os.path.join(directory, 'meta.json'), 'wt') as f:
+                json.dump({'type': 'int8', 'documents': len(self.corpus_embeddings),
+                           'index_version': index_version}, f)
+
+        save_directory(path, write)
+
+    @classmethod
+    def load(cls, path: str, corpus_embeddings: np.ndarray,
+             rerank_factor: int = 4, index_version: Optional[str] = None) -> 'Int8Search':
+        meta = read_meta(path, index_version)
+        if meta['documents'] != len(corpus_embeddings):
+            raise ValueError(f"Int8 codes at {path} were built for {meta['documents']} "
+                             f"documents, corpus has {len(corpus_embeddings)}")
+        int8_search = cls(corpus_embeddings, rerank_factor)
+        int8_search.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode='r')
+        int8_search.scale = np.load(os.path.join(path, 'scale.npy'))
+        return int8_search
+
+
+def load_or_build_int8(path: str, corpus_embeddings: np.ndarray,
+                       rerank_factor: int = 4,
+                       index_version: Optional[str] = None) -> Int8Search:
+    """
+    Loads the int8 codes persisted at path for index_version or builds and
+    saves them.
+    """
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        try:
+            return Int8Search.load(path, corpus_embeddings, rerank_factor, index_version)
+        except ValueError:
+            pass
+    int8_search = Int8Search(corpus_embeddings, rerank_factor).build()
+    int8_search.save(path, index_version)
+    return int8_search
+
+
+def load_or_build_ivf(path: str, corpus_embeddings: np.ndarray,
+                      n_lists: int = None, n_probe: int = 8,
+                      index_version: Optional[str] = None) -> IVFSearch:
+    """
+    Loads the IVF structure persisted at path for index_version or builds
+    and saves it.
+    """
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        try:
+            return IVFSearch.load(path, corpus_embeddings, n_probe, index_version)
+        except ValueError:
+            pass
+    ivf = IVFSearch(corpus_embeddings, n_lists, n_probe).build()
+    ivf.save(path, index_version)
+    return ivf
+
+
+def recall_at_k(approximate_search, exact_search: ExactSearch,
+                query_embeddings: np.ndarray, k_top: int = 10) -> float:
+    """
+    Share of the exact top-k rows found by the approximate search.
+    """
+    found = 0
+    for query_embedding in query_embeddings:
+        exact_rows, _ = exact_search.search(query_embedding, k_top)
+        approximate_rows, _ = approximate_search.search(query_embedding, k_top)
+        found += len(set(exact_rows.tolist()) & set(approximate_rows.tolist()))
+    return found / max(1, len(query_embeddings) * min(k_top, len(exact_search.norms)))
@@ -0,0 +1,62 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Sequence
+
+
+class MicroBatcher:
+    """
+    Coalesces calls of concurrent requests into one batch: items submitted
+    within max_wait_ms of the first one (up to max_batch_size items) are
+    passed to batch_fn together and every caller gets back its own slice.
+    batch_fn: List[item] -> sequence of results, one per item.
+    """
+    def __init__(self, batch_fn: Callable[[List], Sequence],
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0,
+                 name: str = 'micro-batcher'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._serve, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, items: List) -> Future:
+        future = Future()
+        self.requests.put((items, future))
+        return future
+
+    def __call__(self, items: List):
+        return self.submit(items).result()
+
+    def _collect(self) -> list:
+        requests = [self.requests.get()]
+        n_items = len(requests[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while n_items < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+            n_items += len(requests[-1][0])
+        return requests
+
+    def _serve(self):
+        while True:
+            requests = self._collect()
+            items = [item for request_items, _ in requests for item in request_items]
+            try:
+                results = self.batch_fn(items) if items else []
+            except Exception as e:
+                for _, future in requests:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for request_items, future in requests:
+                future.set_result(results[start:start + len(request_items)])
+                start += len(request_items)
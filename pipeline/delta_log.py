@@ -0,0 +1,183 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional, Tuple
+
+SEGMENT_SUFFIX = '.jsonl'
+
+
+class DeltaLogGap(ValueError):
+    """
+    Updates the reader hasn't applied were pruned from the log: the index
+    must be reloaded from a merged version that covers them.
+    """
+
+
+class DeltaLog:
+    """
+    Append-only log of the index updates, shared by the server processes
+    of a host: every update is written here first and every process
+    replays the log, so all of them serve the same documents under the
+    same doc ids.
+    One directory per lineage (a built index and the indexes merged from
+    it), holding segments <first seq>.jsonl of JSON lines
+    {'seq': n, 'op': 'add' | 'remove' | 'merged', ...}. Writers take an
+    exclusive flock on the `lock` file, catch up and append the next seq.
+    seq: last update applied by this reader.
+    """
+    def __init__(self, directory: str, seq: int = 0):
+        self.directory = directory
+        self.seq = seq
+        # read position: segment path and offset after the last full line
+        self.cursor = None
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self.lock_file = open(os.path.join(directory, 'lock'), 'a')
+
+    def __repr__(self):
+        return f'DeltaLog(directory={self.directory}, seq={self.seq})'
+
+    def get_segments(self) -> List[Tuple[int, str]]:
+        """
+        (first seq, path) of the segments, in seq order.
+        """
+        return sorted((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.directory, name))
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def changed(self) -> bool:
+        """
+        Cheap check for updates not read yet.
+        """
+        segments = self.get_segments()
+        if not segments:
+            return False
+        path = segments[-1][1]
+        if self.cursor is None or self.cursor[0] != path:
+            return True
+        return os.path.getsize(path) > self.cursor[1]
+
+    def read_segment(self, path: str, offset: int) -> Iterable[dict]:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            self.cursor = (path, offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # being written, read on the next call
+                    return
+                offset += len(line)
+                self.cursor = (path, offset)
+                yield json.loads(line)
+
+    def catch_up(self, apply: Callable[[dict], None]) -> int:
+        """
+        Applies the entries after seq in order, returns their number.
+        """
+        applied = 0
+        with self.lock:
+            segments = self.get_segments()
+            start = 0
+            for i, (first_seq, _) in enumerate(segments):
+                if first_seq <= self.seq + 1:
+                    start = i
+            for first_seq, path in segments[start:]:
+                if first_seq > self.seq + 1:
+                    raise DeltaLogGap(f'{self} misses the updates before {first_seq}')
+                offset = self.cursor[1] if self.cursor is not None and \
+                    self.cursor[0] == path else 0
+                for entry in self.read_segment(path, offset):
+                    if entry['seq'] <= self.seq:
+                        continue
+                    if entry['seq'] != self.seq + 1:
+                        raise DeltaLogGap(f"{self} misses the updates before {entry['seq']}")
+                    apply(entry)
+                    self.seq = entry['seq']
+                    applied += 1
+        return applied
+
+    @contextmanager
+    def locked(self):
+        """
+        Exclusive access of this process and thread to the log.
+        """
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def repair(self, path: str) -> None:
+        """
+        Cuts the partial last line a writer killed while appending left.
+        """
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def append(self, build_entry: Callable[[], Optional[dict]],
+               apply: Callable[[dict], None]) -> Optional[dict]:
+        """
+        Under the writer lock: catches up, asks build_entry for the update
+        (validated against the caught up state, None logs nothing), writes
+        it with the next seq and applies it.
+        """
+        with self.locked():
+            segments = self.get_segments()
+            if segments:
+                self.repair(segments[-1][1])
+            self.catch_up(apply)
+            entry = build_entry()
+            if entry is None:
+                return None
+            entry['seq'] = self.seq + 1
+            path = segments[-1][1] if segments else \
+                os.path.join(self.directory, f"{entry['seq']:012d}{SEGMENT_SUFFIX}")
+            with open(path, 'ab') as f:
+                f.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.catch_up(apply)
+        return entry
+
+    def rotate(self, apply: Callable[[dict], None]) -> None:
+        """
+        Catches up and starts a new segment at the next seq, so older ones
+        can be pruned.
+        """
+        with self.locked():
+            self.catch_up(apply)
+            segments = self.get_segments()
+            if segments and os.path.getsize(segments[-1][1]):
+                open(os.path.join(self.directory,
+                                  f'{self.seq + 1:012d}{SEGMENT_SUFFIX}'), 'ab').close()
+
+    def prune(self, seq: int) -> None:
+        """
+        Removes the segments whose entries are all covered by seq.
+        """
+        with self.locked():
+            segments = self.get_segments()
+            for (_, path), (next_first_seq, _) in zip(segments, segments[1:]):
+                if next_first_seq - 1 <= seq:
+                    os.remove(path)
+
+
+@contextmanager
+def try_lock(path: str):
+    """
+    Non-blocking exclusive flock on path, yields whether it was acquired.
+    """
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
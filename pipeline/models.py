@@ -0,0 +1,68 @@
+import threading
+from typing import Iterable, Tuple
+
+import stanza
+from sentence_transformers import SentenceTransformer
+
+RUBERT_SENTENCE = "DeepPavlov/rubert-base-cased-sentence"
+
+
+class ModelRegistry:
+    """
+    Loads every model once per process and hands out shared handles.
+    SentenceTransformer wraps the HF AutoModel and its tokenizer, so
+    SentenceBertScorer reuses them instead of loading the weights again.
+    Loading before fork (`preload`) lets worker processes share the weights
+    copy-on-write.
+    """
+    def __init__(self):
+        self.sentence_transformers = dict()
+        self.stanza_pipelines = dict()
+        self.sentiment_model = None
+        self.lock = threading.Lock()
+
+    def get_sentence_transformer(self, name: str = RUBERT_SENTENCE) -> SentenceTransformer:
+        with self.lock:
+            if name not in self.sentence_transformers:
+                model = SentenceTransformer(name)
+                model.eval()
+                self.sentence_transformers[name] = model
+            return self.sentence_transformers[name]
+
+    def get_encoder(self, name: str = RUBERT_SENTENCE) -> Tuple:
+        """
+        Returns the (AutoModel, tokenizer) pair inside the sentence transformer.
+        """
+        transformer = self.get_sentence_transformer(name)[0]
+        return transformer.auto_model, transformer.tokenizer
+
+    def get_stanza_pipeline(self, lang: str = 'ru',
+                            processors: str = 'tokenize,ner') -> stanza.Pipeline:
+        with self.lock:
+            if (lang, processors) not in self.stanza_pipelines:
+                stanza.download(lang)
+                self.stanza_pipelines[(lang, processors)] = \
+                    stanza.Pipeline(lang=lang, processors=processors)
+            return self.stanza_pipelines[(lang, processors)]
+
+    def get_sentiment_model(self):
+        """
+        dostoevsky fastText model, downloaded by
+        `python -m dostoevsky download fasttext-social-network-model`.
+        """
+        with self.lock:
+            if self.sentiment_model is None:
+                from dostoevsky.models import FastTextSocialNetworkModel
+                from dostoevsky.tokenization import RegexTokenizer
+
+                self.sentiment_model = FastTextSocialNetworkModel(
+                    tokenizer=RegexTokenizer())
+            return self.sentiment_model
+
+    def preload(self, names: Iterable[str] = (RUBERT_SENTENCE,)) -> None:
+        for name in names:
+            self.get_sentence_transformer(name)
+        self.get_stanza_pipeline()
+
+
+registry = ModelRegistry()
@@ -0,0 +1,131 @@
+from collections import Counter
+from typing import List
+
+import numpy as np
+from scipy import sparse
+
+from index import InvertedIndex
+from index_storage import MmapPostings, iter_entity_presence
+
+
+class ScoringEngine:
+    """
+    Scores all candidates of a query at once over sparse doc x entity
+    matrices instead of per document python loops.
+    For a memory-mapped index (or a SegmentedIndex over one) the matrices
+    wrap the mapped postings and the presence arrays written at build time,
+    so the worker processes share their pages. Other indexes are converted
+    once. Documents with ids >= n_documents (added after the base) aren't
+    covered.
+    """
+    def __init__(self, index: InvertedIndex, b: float = 0.75, k: float = 1.5):
+        self.index = index
+        self.b = b
+        self.k = k
+        base = getattr(index, 'base', index)
+        self.entities = list(base.index.keys())
+        self.entity_columns = {entity: column
+                               for column, entity in enumerate(self.entities)}
+        self.n_documents = max(base.db.keys(), default=-1) + 1
+        if isinstance(base.index, MmapPostings):
+            offsets, doc_ids, frequencies = \
+                base.index.offsets, base.index.doc_ids, base.index.frequencies
+        else:
+            posting_lists = [base.index[entity] for entity in self.entities]
+            offsets = np.cumsum([0] + [len(posting_list) for posting_list in posting_lists])
+            doc_ids = np.concatenate([np.asarray(posting_list.doc_ids, dtype=np.int32)
+                                      for posting_list in posting_lists]) \
+                if posting_lists else np.zeros(0, dtype=np.int32)
+            frequencies = np.concatenate([np.asarray(posting_list.frequencies, dtype=np.int32)
+                                          for posting_list in posting_lists]) \
+                if posting_lists else np.zeros(0, dtype=np.int32)
+        # the postings sorted by entity are the CSC layout, no copy is made
+        self.frequency = sparse.csc_matrix((frequencies, doc_ids, offsets),
+                                           shape=(self.n_documents, len(self.entities)))
+        self.document_total_frequency = getattr(base, 'document_entity_frequency', None)
+        if self.document_total_frequency is None:
+            self.document_total_frequency = np.bincount(
+                doc_ids, weights=frequencies, minlength=self.n_documents)
+        self.presence_indptr = getattr(base, 'presence_indptr', None)
+        self.presence_indices = getattr(base, 'presence_indices', None)
+        if self.presence_indptr is None:
+            self.build_entity_presence(base.db)
+
+    def build_entity_presence(self, db) -> None:
+        """
+        Presence CSR of an index without the build time arrays.
+        """
+        documents = (db.get(doc_id) for doc_id in range(self.n_documents))
+        rows = list(iter_entity_presence(
+            (document['entity'] if document is not None else None
+             for document in documents), self.entity_columns))
+        self.presence_indptr = np.cumsum([0] + [len(row) for row in rows])
+        self.presence_indices = np.concatenate(rows) if rows \
+            else np.zeros(0, dtype=np.int32)
+
+    def get_idf(self, entities: List[str]) -> np.ndarray:
+        return np.array([self.index.idf[entity] for entity in entities],
+                        dtype=np.float64)
+
+    def get_bm25_matrix(self, doc_ids: np.ndarray, entities: List[str],
+                        news_total_entity_frequency: int) -> sparse.csr_matrix:
+        weights = self.frequency[:, [self.entity_columns[entity]
+                                     for entity in entities]].tocsr()[doc_ids]
+        weights.sort_indices()
+        rows = np.repeat(np.arange(len(doc_ids)), np.diff(weights.indptr))
+        document_entity_tf = weights.data / \
+            self.document_total_frequency[doc_ids][rows]
+        length_norm = self.k * (1 - self.b + self.b *
+                                self.index.length_norm[doc_ids][rows])
+        weights.data = self.get_idf(entities)[weights.indices] * \
+            (document_entity_tf * (self.k + 1)) / \
+            (document_entity_tf + length_norm) * news_total_entity_frequency
+        return weights
+
+    def get_intersection_matrix(self, doc_ids: np.ndarray,
+                                entities: List[str]) -> sparse.csr_matrix:
+        """
+        Reads the presence rows of the candidates only.
+        """
+        starts = np.asarray(self.presence_indptr[doc_ids], dtype=np.int64)
+        lengths = np.asarray(self.presence_indptr[doc_ids + 1], dtype=np.int64) - starts
+        rows = np.repeat(np.arange(len(doc_ids)), lengths)
+        positions = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths),
+                                                          lengths)
+        document_columns = np.asarray(self.presence_indices[positions], dtype=np.int64)
+        columns = np.array([self.entity_columns[entity] for entity in entities], dtype=np.int64)
+        order = np.argsort(columns)
+        found = np.minimum(np.searchsorted(columns[order], document_columns), len(columns) - 1)
+        matched = columns[order][found] == document_columns
+        entity_positions = order[found[matched]]
+        weights = sparse.csr_matrix((self.get_idf(entities)[entity_positions],
+                                     (rows[matched], entity_positions)),
+                                    shape=(len(doc_ids), len(entities)))
+        weights.sort_indices()
+        return weights
+
+    def rank(self, doc_ids: List[int], news_entity_frequency: Counter,
+             scoring_type: str = 'intersection') -> list:
+        """
+        Returns (doc_id, score, per-entity scores) for every candidate.
+        """
+        doc_ids = np.asarray(sorted(doc_ids), dtype=np.int64)
+        entities = [entity for entity in news_entity_frequency
+                    if entity in self.entity_columns]
+        if not entities or not len(doc_ids):
+            return [(doc_id, 0, dict()) for doc_id in doc_ids.tolist()]
+        if scoring_type == 'bm_25':
+            weights = self.get_bm25_matrix(doc_ids, entities,
+                                           sum(news_entity_frequency.values()))
+        elif scoring_type == 'intersection':
+            weights = self.get_intersection_matrix(doc_ids, entities)
+        else:
+            raise ValueError(f"Unknown scoring type: {scoring_type}")
+        scores = weights @ np.ones(len(entities))
+        return [
+            (doc_id, scores[row],
+             {entities[column]: value for column, value in
+              zip(weights.indices[weights.indptr[row]:weights.indptr[row + 1]].tolist(),
+                  weights.data[weights.indptr[row]:weights.indptr[row + 1]].tolist())})
+            for row, doc_id in enumerate(doc_ids.tolist())
+        ]
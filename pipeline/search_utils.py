@@ -2,11 +2,71 @@ import pymorphy2
 import pandas as pd
 import re
 import stanza
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict, deque
+from typing import Dict, Iterable, Iterator, List, Tuple
 from tqdm import tqdm
 
 
 morph = pymorphy2.MorphAnalyzer() # when server starts
-morph_lemmatizer = lambda word: morph.parse(word)[0].normal_form
+
+
+class CachedLemmatizer:
+    """
+    pymorphy2 normal form with a bounded LRU cache in front of the analyzer.
+    The warm set (word -> normal form, shipped with the index) is pinned
+    and never evicted.
+    """
+    def __init__(self, morph_analyzer: pymorphy2.MorphAnalyzer,
+                 maxsize: int = 65536):
+        self.morph = morph_analyzer
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.warm_set = dict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, word: str) -> str:
+        normal_form = self.warm_set.get(word)
+        if normal_form is not None:
+            with self.lock:
+                self.hits += 1
+            return normal_form
+        with self.lock:
+            normal_form = self.cache.get(word)
+            if normal_form is not None:
+                self.cache.move_to_end(word)
+                self.hits += 1
+                return normal_form
+        normal_form = self.morph.parse(word)[0].normal_form
+        with self.lock:
+            self.misses += 1
+            self.cache[word] = normal_form
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return normal_form
+
+    def warm_up(self, warm_set: Dict[str, str]) -> None:
+        self.warm_set.update(warm_set)
+
+    def cache_info(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.cache), 'maxsize': self.maxsize,
+                'warm_set': len(self.warm_set)}
+
+
+morph_lemmatizer = CachedLemmatizer(morph)
+
+
+def build_lemma_warm_set(words: Iterable[str], size: int = 10000,
+                         lemmatizer=morph_lemmatizer) -> Dict[str, str]:
+    """
+    Normal forms of the `size` most frequent words.
+    """
+    return {word: lemmatizer(word)
+            for word, _ in Counter(words).most_common(size)}
 
 
 def lemmatize_text(text: str, lemmatizer=morph_lemmatizer) -> str:
@@ -46,7 +106,138 @@ def extract_entity_sentence(text: int, entity_idx: int) -> str:
     return extract_sentence_by_idx(text, entity_idx).strip()
 
 
+class SentenceSpans:
+    """
+    Sentence end offsets of a text computed once, offset -> sentence is a
+    binary search. Gives the same sentences as extract_sentence_by_idx:
+    from the char after the previous end to the next end char at or after
+    the offset (excluded).
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.ends = [match.start() for match in re.finditer(r'[.!?…]', text)]
+
+    def span_at(self, idx: int) -> Tuple[int, int]:
+        position = bisect_left(self.ends, idx)
+        start = self.ends[position - 1] + 1 if position else 0
+        end = self.ends[position] if position < len(self.ends) else len(self.text)
+        return start, end
+
+    def sentence_at(self, idx: int) -> str:
+        start, end = self.span_at(idx)
+        return self.text[start:end].strip()
+
+    @property
+    def spans(self) -> List[Tuple[int, int]]:
+        """
+        (start, end) of every sentence, end chars excluded.
+        """
+        starts = [0] + [end + 1 for end in self.ends]
+        ends = self.ends + [len(self.text)]
+        return list(zip(starts, ends))
+
+
 def find_all_entities(text: str, entity: str) -> int:
     for match in re.finditer(r'(?:^|\W){}(?:$|\W)'.format(re.escape(entity)),
                              text, re.S):
         yield match.start()
+
+
+def is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+class EntityLocator:
+    """
+    Aho-Corasick automaton over a set of raw entities: a single pass over
+    the text finds the occurrences of all of them. find_all keeps the
+    offsets find_all_entities yields for each entity.
+    """
+    def __init__(self, entities: Iterable[str]):
+        self.entities = set(entities)
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [[]]
+        for entity in self.entities:
+            if entity:
+                self._add(entity)
+        self._build_fail_links()
+
+    def _add(self, entity: str) -> None:
+        node = 0
+        for char in entity:
+            next_node = self.goto[node].get(char)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto.append(dict())
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[node][char] = next_node
+            node = next_node
+        self.output[node].append(entity)
+
+    def _build_fail_links(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(char, 0)
+                self.output[next_node] = self.output[next_node] + \
+                    self.output[self.fail[next_node]]
+
+    def iter_occurrences(self, text: str) -> Iterator[Tuple[int, str]]:
+        """
+        (start, entity) of every occurrence, overlapping ones included,
+        ordered by end offset.
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        for idx, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for entity in output[node]:
+                yield idx - len(entity) + 1, entity
+
+    def find_all(self, text: str) -> Dict[str, List[int]]:
+        """
+        Same offsets as find_all_entities per entity: the match starts at
+        the non-word char before the entity (or at 0), the entity is
+        followed by a non-word char or the end of the text, and the scan
+        is non-overlapping because that trailing char is consumed.
+        """
+        occurrences = defaultdict(list)
+        for start, entity in self.iter_occurrences(text):
+            occurrences[entity].append(start)
+        text_len = len(text)
+        entity_offsets = dict()
+        for entity in self.entities:
+            if not entity:
+                entity_offsets[entity] = list(find_all_entities(text, entity))
+                continue
+            offsets = []
+            search_pos = 0
+            for start in sorted(occurrences.get(entity, [])):
+                end = start + len(entity)
+                if start == 0:
+                    match_start = 0
+                elif not is_word_char(text[start - 1]):
+                    match_start = start - 1
+                else:
+                    continue
+                if end == text_len or (end == text_len - 1 and text[end] == '\n'):
+                    match_end = end
+                elif not is_word_char(text[end]):
+                    match_end = end + 1
+                else:
+                    continue
+                if match_start < search_pos:
+                    continue
+                offsets.append(match_start)
+                search_pos = match_end
+            entity_offsets[entity] = offsets
+        return entity_offsets
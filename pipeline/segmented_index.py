@@ -0,0 +1,361 @@
+import threading
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from index import Database, InvertedIndex, PostingList, analyze_document, calculate_idf
+from index_builder import StreamingIndexBuilder
+
+
+class SegmentedPostings(Mapping):
+    """
+    entity -> PostingList over the base and the delta segment, tombstoned
+    documents are filtered out.
+    """
+    def __init__(self, segmented: 'SegmentedIndex'):
+        self.segmented = segmented
+
+    def __getitem__(self, entity: str) -> PostingList:
+        segmented = self.segmented
+        base = segmented.base.index[entity] if entity in segmented.base.index else None
+        delta = segmented.delta_postings.get(entity)
+        if base is None and delta is None:
+            raise KeyError(entity)
+        if delta is None and not segmented.deleted:
+            return base
+        posting_lists = [posting_list for posting_list in (base, delta)
+                         if posting_list is not None]
+        doc_ids = np.concatenate([np.asarray(posting_list.doc_ids, dtype=np.int32)
+                                  for posting_list in posting_lists])
+        frequencies = np.concatenate([np.asarray(posting_list.frequencies, dtype=np.int32)
+                                      for posting_list in posting_lists])
+        if segmented.deleted:
+            live = ~np.isin(doc_ids, segmented.deleted_ids)
+            doc_ids, frequencies = doc_ids[live], frequencies[live]
+        if not len(doc_ids):
+            raise KeyError(entity)
+        return PostingList(doc_ids, frequencies)
+
+    def __contains__(self, entity) -> bool:
+        return self.segmented.document_frequency.get(entity, 0) > 0
+
+    def __iter__(self):
+        return iter(self.segmented.document_frequency)
+
+    def __len__(self):
+        return len(self.segmented.document_frequency)
+
+
+class SegmentedDocumentFrequency(Mapping):
+    """
+    Live document frequency: base + delta - tombstoned documents.
+    """
+    def __init__(self, segmented: 'SegmentedIndex'):
+        self.segmented = segmented
+
+    def __getitem__(self, entity: str) -> int:
+        segmented = self.segmented
+        frequency = segmented.base.document_frequency.get(entity, 0) + \
+            segmented.delta_document_frequency[entity] - \
+            segmented.deleted_document_frequency[entity]
+        if frequency <= 0:
+            raise KeyError(entity)
+        return frequency
+
+    def __iter__(self):
+        segmented = self.segmented
+        for entity in segmented.base.document_frequency:
+            if entity in self:
+                yield entity
+        for entity in segmented.delta_document_frequency:
+            if entity not in segmented.base.document_frequency and entity in self:
+                yield entity
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class SegmentedIdf(Mapping):
+    """
+    idf computed on access from the live document frequency.
+    """
+    def __init__(self, segmented: 'SegmentedIndex'):
+        self.segmented = segmented
+
+    def __getitem__(self, entity: str) -> float:
+        document_frequency = self.segmented.document_frequency[entity]
+        return calculate_idf([document_frequency], len(self.segmented.db))[0].item()
+
+    def __iter__(self):
+        return iter(self.segmented.document_frequency)
+
+    def __len__(self):
+        return len(self.segmented.document_frequency)
+
+
+class SegmentedDatabase:
+    """
+    Documents of both segments, tombstoned ones are hidden.
+    """
+    def __init__(self, segmented: 'SegmentedIndex'):
+        self.segmented = segmented
+
+    def __repr__(self):
+        return f'SegmentedDatabase(documents={len(self)})'
+
+    def __len__(self):
+        segmented = self.segmented
+        return len(segmented.base.db) - len(segmented.base_deleted) + \
+            len(segmented.delta_db) - len(segmented.deleted)
+
+    def get(self, docId: int) -> Optional[dict]:
+        segmented = self.segmented
+        if docId in segmented.deleted:
+            return None
+        if docId < segmented.base_n_documents:
+            return segmented.base.db.get(docId)
+        return segmented.delta_db.get(docId)
+
+    def keys(self):
+        segmented = self.segmented
+        if not segmented.deleted and not segmented.base_deleted:
+            return list(segmented.base.db.keys()) + list(segmented.delta_db.keys())
+        return [doc_id for keys in (segmented.base.db.keys(), segmented.delta_db.keys())
+                for doc_id in keys
+                if doc_id not in segmented.deleted and doc_id not in segmented.base_deleted]
+
+
+class SegmentedLengthNorm:
+    """
+    (doc_len / avg_len) of the requested doc ids over both segments,
+    tombstoned documents give 0. Nothing per document is rebuilt on an
+    update, only the average changes.
+    """
+    def __init__(self, segmented: 'SegmentedIndex'):
+        self.segmented = segmented
+
+    def __len__(self):
+        return self.segmented.n_documents
+
+    def __getitem__(self, doc_ids) -> np.ndarray:
+        segmented = self.segmented
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        document_len = np.zeros(doc_ids.shape, dtype=np.float64)
+        in_base = doc_ids < segmented.base_n_documents
+        document_len[in_base] = np.asarray(segmented.base.document_len)[doc_ids[in_base]]
+        document_len[~in_base] = np.frombuffer(segmented.delta_document_len, dtype=np.int32)[
+            doc_ids[~in_base] - segmented.base_n_documents]
+        if segmented.deleted:
+            document_len[np.isin(doc_ids, segmented.deleted_ids)] = 0
+        if not segmented.avg_document_len:
+            return np.zeros(doc_ids.shape, dtype=np.float64)
+        return document_len / segmented.avg_document_len
+
+
+class SegmentedIndex:
+    """
+    Index of an immutable base segment (a built index) and a small in-memory
+    delta segment: added documents are searchable right away, removals are
+    tombstones. Document frequency, idf, lengths and the length
+    normalization are live over both segments.
+    write stores the live documents of both segments as a new memory-mapped
+    base. Doc ids never change: deleted documents stay gaps of the base,
+    which are neither in its postings nor tombstones of the index opened on
+    it.
+    Updates replayed from a delta_log.DeltaLog pass their seq, the index
+    tracks the last one applied.
+    Exposes the InvertedIndex attributes the searchers and the scorer use.
+    """
+    def __init__(self, base: InvertedIndex):
+        self.base = base
+        self.base_n_documents = max(base.db.keys(), default=-1) + 1
+        self.delta_db = Database()
+        self.delta_postings = dict()
+        self.delta_document_frequency = Counter()
+        self.delta_document_len = array('i')
+        self.delta_total_document_len = 0
+        # gaps of a merged base: the base has no document for them
+        self.base_deleted = frozenset(np.asarray(getattr(base, 'deleted_ids', ()),
+                                                 dtype=np.int64).tolist())
+        self.deleted = set()
+        self.deleted_ids = np.zeros(0, dtype=np.int32)
+        self.deleted_document_frequency = Counter()
+        self.deleted_document_len = 0
+        self.updates = 0
+        self.lineage = getattr(base, 'delta_lineage', None) or base.version
+        self.seq = getattr(base, 'delta_seq', 0)
+        self.lock = threading.RLock()
+        self._delta_embeddings = None
+
+        self.index = SegmentedPostings(self)
+        self.db = SegmentedDatabase(self)
+        self.document_frequency = SegmentedDocumentFrequency(self)
+        self.idf = SegmentedIdf(self)
+        self.length_norm = SegmentedLengthNorm(self)
+        self.sentence_store = base.sentence_store
+        self.entity_lemmatizer = base.entity_lemmatizer
+        self.entity_context_len = base.entity_context_len
+        self.lemma_warm_set = getattr(base, 'lemma_warm_set', dict())
+        self.calculate_statistics()
+
+    def __repr__(self):
+        return f'SegmentedIndex(base={self.base_n_documents}, ' \
+            f'delta={len(self.delta_db)}, deleted={len(self.deleted)})'
+
+    @property
+    def version(self) -> str:
+        if not self.updates:
+            return self.base.version
+        return f'{self.base.version}+{self.updates}'
+
+    @property
+    def n_documents(self) -> int:
+        """
+        Next doc id, tombstoned documents included.
+        """
+        return self.base_n_documents + len(self.delta_document_len)
+
+    @property
+    def delta_size(self) -> int:
+        """
+        Updates the next merge folds into the base.
+        """
+        return len(self.delta_db) + len(self.deleted)
+
+    def calculate_statistics(self) -> None:
+        self.total_document_len = self.base.total_document_len + \
+            self.delta_total_document_len - self.deleted_document_len
+        n_documents = len(self.db)
+        self.avg_document_len = self.total_document_len / n_documents \
+            if n_documents else 0
+
+    def mark(self, seq: Optional[int] = None) -> None:
+        """
+        Counts an update that changes no document, e.g. a merge notice of
+        the delta log, so replicas replaying the log agree on the version.
+        """
+        with self.lock:
+            self.count_update(seq)
+
+    def count_update(self, seq: Optional[int]) -> None:
+        self.updates += 1
+        if seq is not None:
+            self.seq = seq
+
+    def add_documents(self, documents: Iterable[dict],
+                      raw_entities_col_name: str = 'raw_entity',
+                      seq: Optional[int] = None) -> List[int]:
+        """
+        Analyzes and adds documents to the delta segment, returns their doc
+        ids. Entity context sentences have no sentence store ids, the scorer
+        encodes them on the fly until the next index build.
+        """
+        documents = [analyze_document(document, raw_entities_col_name,
+                                      self.entity_lemmatizer)
+                     for document in documents]
+        return self.add_analyzed_documents(documents, seq)
+
+    def add_analyzed_documents(self, documents: List[dict],
+                               seq: Optional[int] = None) -> List[int]:
+        """
+        Documents get the next doc ids, in order.
+        """
+        with self.lock:
+            doc_ids = []
+            for document in documents:
+                document['id'] = self.n_documents
+                if 'embedding' not in document:
+                    document['embedding'] = \
+                        torch.tensor(document['rubert-base-cased-sentence_embedding'])
+                for entity, frequency in document['entity_frequency'].items():
+                    if entity not in self.delta_postings:
+                        self.delta_postings[entity] = PostingList()
+                    self.delta_postings[entity].append(document['id'], frequency)
+                    self.delta_document_frequency[entity] += 1
+                self.delta_document_len.append(document['text_len'])
+                self.delta_total_document_len += document['text_len']
+                self.delta_db.add(document)
+                doc_ids.append(document['id'])
+            self.count_update(seq)
+            self._delta_embeddings = None
+            self.calculate_statistics()
+            return doc_ids
+
+    def remove_document(self, docId: int, seq: Optional[int] = None) -> Optional[dict]:
+        """
+        Tombstones a document of either segment. A logged update (seq) that
+        finds no document still counts.
+        """
+        with self.lock:
+            document = self.db.get(docId)
+            if document is None:
+                if seq is not None:
+                    self.count_update(seq)
+                return None
+            self.deleted.add(docId)
+            self.deleted_ids = np.fromiter(self.deleted, dtype=np.int32,
+                                           count=len(self.deleted))
+            self.deleted_document_frequency.update(document['entity_frequency'].keys())
+            self.deleted_document_len += document['text_len']
+            self.count_update(seq)
+            self._delta_embeddings = None
+            self.calculate_statistics()
+            return document
+
+    def lookup_query(self, normalized_entities: set) -> dict:
+        return {entity: self.index[entity] for entity in normalized_entities
+                if entity in self.index}
+
+    def get_corpus_embeddings(self):
+        doc_ids, corpus_embeddings = self.base.get_corpus_embeddings()
+        delta_doc_ids, delta_embeddings = self.get_delta_embeddings(self.base_n_documents)
+        if not len(delta_doc_ids):
+            return doc_ids, corpus_embeddings
+        return list(doc_ids) + delta_doc_ids, \
+            torch.cat([corpus_embeddings, torch.from_numpy(delta_embeddings)])
+
+    def get_delta_embeddings(self, start_id: int) -> Tuple[List[int], np.ndarray]:
+        """
+        Live delta documents with doc id >= start_id and their embeddings.
+        """
+        delta_embeddings = self._delta_embeddings
+        if delta_embeddings is None:
+            doc_ids = [doc_id for doc_id in self.delta_db.keys()
+                       if doc_id not in self.deleted]
+            embeddings = np.stack([self.delta_db.get(doc_id)['embedding'].numpy()
+                                   for doc_id in doc_ids]).astype(np.float32) \
+                if doc_ids else np.zeros((0, 0), dtype=np.float32)
+            delta_embeddings = self._delta_embeddings = (doc_ids, embeddings)
+        doc_ids, embeddings = delta_embeddings
+        start = int(np.searchsorted(doc_ids, start_id))
+        return doc_ids[start:], embeddings[start:]
+
+    def snapshot(self) -> Tuple[set, int, str, int]:
+        """
+        Live doc ids, next doc id, delta log lineage and seq.
+        """
+        with self.lock:
+            return set(self.db.keys()), self.n_documents, self.lineage, self.seq
+
+    def write(self, path: str, snapshot: Optional[Tuple[set, int, str, int]] = None) -> str:
+        """
+        Writes the documents of a snapshot (the current state by default) as
+        a memory-mapped index at path, deleted ones as gaps, and returns its
+        version. The index records the lineage and seq of the delta log it
+        covers. Documents removed after the snapshot are written as gaps.
+        """
+        live_ids, n_documents, lineage, seq = snapshot or self.snapshot()
+        builder = StreamingIndexBuilder(path, entity_lemmatizer=self.entity_lemmatizer,
+                                        sentence_store=self.sentence_store,
+                                        entity_context_len=self.entity_context_len)
+        for doc_id in range(n_documents):
+            document = self.db.get(doc_id) if doc_id in live_ids else None
+            if document is None:
+                builder.add_deleted(doc_id)
+                continue
+            builder.add_analyzed_document(dict(document))
+        return builder.close(delta_lineage=lineage, delta_seq=seq)
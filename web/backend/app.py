@@ -1,10 +1,16 @@
+import asyncio
+import hmac
+import os
 from typing import List, Optional
 
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI, Header, HTTPException
 from pydantic import BaseModel
 
 import sentiment
+from executor import InferenceExecutor
 from pipeline import pipeline
+from pipeline.delta_log import DeltaLogGap
+from result_cache import ResultCache
 
 app = FastAPI(
     title="Fake news API",
@@ -42,17 +48,99 @@ class CheckResponse(BaseModel):
     ner: List[str]
 
 
-@app.on_event('startup')
-def startup():
-    pipeline.setup('index.pickle')
+class IndexDocument(BaseModel):
+    url: str
+    text: str
+    title: Optional[str]
+    raw_entity: Optional[List[str]]
+    entity: Optional[List[str]]
+    tonality: Optional[SentimentResponse]
 
 
-@app.post('/check')
-def check(item: CheckItem):
-    score, doc_id_top, doc_sentences = pipeline.estimate_news_paper(item.content)
-    #print(candidates)
-    #print(scores)
-    highlight_info = pipeline.highlight(doc_id_top, doc_sentences)
+class IndexUpdateResponse(BaseModel):
+    doc_ids: List[int]
+    version: str
+
+
+class IndexStatusResponse(BaseModel):
+    version: str
+    documents: int
+    delta_size: int
+    index_path: str
+    reloading: bool
+    merging: bool
+    error: Optional[str]
+
+
+executor: Optional[InferenceExecutor] = None
+result_cache: Optional[ResultCache] = None
+admin_token: Optional[str] = None
+
+
+def get_index_path() -> str:
+    """
+    INDEX_PATH, by default the index directory, or index.pickle for a
+    deployment that still serves a pickle built before the directory format.
+    """
+    index_path = os.environ.get('INDEX_PATH')
+    if index_path:
+        return index_path
+    if not os.path.exists('index') and os.path.exists('index.pickle'):
+        return 'index.pickle'
+    return 'index'
+
+
+def require_admin(authorization: Optional[str] = Header(None)) -> None:
+    """
+    The routes that change the served corpus are proxied to the public
+    with the rest of /api: they need `Authorization: Bearer <ADMIN_TOKEN>`
+    and are disabled when ADMIN_TOKEN is not set.
+    """
+    if not admin_token:
+        raise HTTPException(status_code=403, detail='Index administration is disabled')
+    if authorization is None or \
+            not hmac.compare_digest(authorization.encode('utf-8'),
+                                    f'Bearer {admin_token}'.encode('utf-8')):
+        raise HTTPException(status_code=401, detail='Admin token required',
+                            headers={'WWW-Authenticate': 'Bearer'})
+
+
+@app.on_event('startup')
+def startup():
+    global executor
+    global result_cache
+    global admin_token
+    admin_token = os.environ.get('ADMIN_TOKEN') or None
+    executor = InferenceExecutor.from_env()
+    micro_batching = os.environ.get('MICRO_BATCHING', '0') == '1'
+    micro_batch_wait_ms = float(os.environ.get('MICRO_BATCH_WAIT_MS', 5))
+    pipeline.setup(get_index_path(),
+                   ann_backend=os.environ.get('ANN_BACKEND', 'exact'),
+                   ann_n_probe=int(os.environ.get('ANN_N_PROBE', 8)),
+                   ann_rerank_factor=int(os.environ.get('ANN_RERANK_FACTOR', 4)),
+                   micro_batching=micro_batching,
+                   micro_batch_wait_ms=micro_batch_wait_ms,
+                   inference_backend=os.environ.get('INFERENCE_BACKEND', 'eager'),
+                   onnx_path=os.environ.get('ONNX_MODEL_PATH'),
+                   segment_merge_size=int(os.environ.get('SEGMENT_MERGE_SIZE', 10000)))
+    sentiment.setup(micro_batching=micro_batching,
+                    micro_batch_wait_ms=micro_batch_wait_ms)
+    result_cache = ResultCache.from_env()
+    result_cache.invalidate(pipeline.view.version)
+    watch_interval = float(os.environ.get('INDEX_WATCH_INTERVAL', 0))
+    if watch_interval > 0:
+        pipeline.watch_index(watch_interval)
+
+
+@app.on_event('shutdown')
+def shutdown():
+    pipeline.watch_stop.set()
+    executor.shutdown()
+    result_cache.close()
+
+
+def build_check_response(item: CheckItem, score, doc_id_top: list,
+                         highlight_info: dict, item_sentiment: dict) -> CheckResponse:
     result = CheckResponse(result=int(score[1] * 100), items=[], ner=[])
     #items = sorted(zip(candidates, scores.items()), key=lambda x: x[1][1],reverse=True)
 
@@ -70,6 +158,86 @@ def check(item: CheckItem):
                              score=int(doc['score'] * 100),sentiment=SentimentResponse(**doc['tonality']))
         result.items.append(find_item)
     result.ner = list(ners)
-    result.sentiment = SentimentResponse(**sentiment.predict(item.content))
-
+    result.sentiment = SentimentResponse(**item_sentiment)
     return result
+
+
+@app.post('/check')
+async def check(item: CheckItem):
+    # updates other workers logged, the version keys the shared cache
+    await asyncio.get_running_loop().run_in_executor(None, pipeline.sync_updates)
+    # one view for the whole request, an index swap doesn't affect it
+    view = pipeline.view
+    version = view.version
+    cache_key = ResultCache.get_key(item.content, version)
+    cached = await result_cache.get_async(cache_key)
+    if cached is not None:
+        return build_check_response(item, *cached)
+    async with executor.admit():
+        (score, doc_id_top, doc_sentences), item_sentiment = await asyncio.gather(
+            executor.run('estimate', pipeline.estimate_news_paper, item.content,
+                         index_view=view),
+            executor.run('sentiment', sentiment.predict, item.content))
+        #print(candidates)
+        #print(scores)
+        highlight_info = pipeline.highlight(doc_id_top, doc_sentences, view)
+    result = (score, doc_id_top, highlight_info, item_sentiment)
+    await result_cache.put_async(cache_key, result, version)
+    return build_check_response(item, *result)
+
+
+def index_documents(documents: List[IndexDocument]) -> List[int]:
+    prepared = []
+    for document in documents:
+        prepared.append({key: value for key, value in document.dict().items()
+                         if value is not None})
+        if document.tonality is None:
+            prepared[-1]['tonality'] = sentiment.predict(document.text)
+    return pipeline.add_documents(prepared)
+
+
+@app.post('/index/documents', response_model=IndexUpdateResponse,
+          dependencies=[Depends(require_admin)])
+async def add_documents(documents: List[IndexDocument]):
+    """
+    Makes parsed articles searchable without an index rebuild, in every
+    worker. The index stage has no timeout: a write is never answered with
+    504, a 503 means nothing was written and the request can be retried.
+    """
+    async with executor.admit():
+        try:
+            doc_ids = await executor.run('index', index_documents, documents)
+        except DeltaLogGap as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    return IndexUpdateResponse(doc_ids=doc_ids, version=pipeline.view.version)
+
+
+@app.delete('/index/documents/{doc_id}', response_model=IndexUpdateResponse,
+            dependencies=[Depends(require_admin)])
+async def remove_document(doc_id: int):
+    async with executor.admit():
+        try:
+            removed = await executor.run('index', pipeline.remove_document, doc_id)
+        except DeltaLogGap as e:
+            raise HTTPException(status_code=409, detail=str(e))
+    if not removed:
+        raise HTTPException(status_code=404, detail=f'No document {doc_id}')
+    return IndexUpdateResponse(doc_ids=[doc_id], version=pipeline.view.version)
+
+
+@app.get('/index', response_model=IndexStatusResponse)
+async def index_status():
+    await asyncio.get_running_loop().run_in_executor(None, pipeline.sync_updates)
+    return IndexStatusResponse(**pipeline.index_status())
+
+
+@app.post('/index/reload', response_model=IndexStatusResponse, status_code=202,
+          dependencies=[Depends(require_admin)])
+async def reload_index():
+    """
+    Reloads the configured index (INDEX_PATH) in background and swaps it
+    in once checked, /index reports the progress.
+    """
+    if not pipeline.reload_in_background():
+        raise HTTPException(status_code=409, detail='Index reload in progress')
+    return IndexStatusResponse(**pipeline.index_status())
@@ -1,7 +1,3 @@
-import stanza
-from transformers import AutoTokenizer, AutoModel
+from pipeline.models import registry
 
-stanza.download('ru')
-nlp = stanza.Pipeline(lang='ru', processors='tokenize,ner')
-sentence_bert_tokenizer = AutoTokenizer.from_pretrained("DeepPavlov/rubert-base-cased-sentence")
-sentence_bert_model = AutoModel.from_pretrained("DeepPavlov/rubert-base-cased-sentence")
\ No newline at end of file
+registry.preload()
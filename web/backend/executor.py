@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import torch
+from fastapi import HTTPException
+
+
+class InferenceExecutor:
+    """
+    Bounded thread pool for the CPU-heavy pipeline stages.
+    Threads share the loaded models (torch releases the GIL inside its ops),
+    a process pool would need a copy of every model per process.
+    Requests beyond max_queue_depth are rejected with 503, a stage running
+    longer than its timeout answers 504. A stage with a None timeout, like
+    the index writes, always runs to completion.
+    """
+    def __init__(self, max_workers: int = 2,
+                 max_queue_depth: int = 8,
+                 torch_threads: Optional[int] = None,
+                 stage_timeouts: Optional[Dict[str, Optional[float]]] = None,
+                 default_timeout: float = 30.0):
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix='inference')
+        self.max_queue_depth = max_queue_depth
+        self.stage_timeouts = stage_timeouts or dict()
+        self.default_timeout = default_timeout
+        self.in_flight = 0
+
+    @classmethod
+    def from_env(cls) -> 'InferenceExecutor':
+        max_workers = int(os.environ.get('INFERENCE_WORKERS', 2))
+        torch_threads = int(os.environ.get(
+            'TORCH_THREADS', max(1, (os.cpu_count() or 1) // max_workers)))
+        return cls(max_workers=max_workers,
+                   max_queue_depth=int(os.environ.get('INFERENCE_QUEUE_DEPTH', 8)),
+                   torch_threads=torch_threads,
+                   stage_timeouts={
+                       'estimate': float(os.environ.get('ESTIMATE_TIMEOUT', 30)),
+                       'sentiment': float(os.environ.get('SENTIMENT_TIMEOUT', 5)),
+                       # a write that timed out would still commit
+                       'index': None,
+                   })
+
+    @asynccontextmanager
+    async def admit(self):
+        """
+        Back-pressure: holds a slot of the request queue for the request.
+        """
+        if self.in_flight >= self.max_queue_depth:
+            raise HTTPException(status_code=503,
+                                detail='Server is busy, retry later',
+                                headers={'Retry-After': '1'})
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    async def run(self, stage: str, func, *args, **kwargs):
+        """
+        Runs func in the pool. On timeout the request fails with 504: a
+        stage still queued is cancelled, a running one can't be stopped and
+        keeps a slot of the request queue until it returns, so timed out
+        work never piles up in the pool beyond max_queue_depth.
+        """
+        loop = asyncio.get_running_loop()
+        pool_future = self.pool.submit(functools.partial(func, *args, **kwargs))
+        future = asyncio.wrap_future(pool_future)
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future), self.stage_timeouts.get(stage, self.default_timeout))
+        except asyncio.TimeoutError:
+            self.hold_until_done(pool_future, loop)
+            raise HTTPException(status_code=504,
+                                detail=f'{stage} stage timed out')
+        except asyncio.CancelledError:
+            # the client went away
+            self.hold_until_done(pool_future, loop)
+            raise
+
+    def hold_until_done(self, pool_future, loop) -> None:
+        if pool_future.cancel():
+            return
+        self.in_flight += 1
+        pool_future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self.release))
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -1,8 +1,11 @@
-from collections import Counter, defaultdict
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict, deque
 
 import argparse
 import itertools
 import json
+import multiprocessing
 import numpy as np
 import pandas as pd
 import pymorphy2
@@ -10,11 +13,11 @@ import torch
 from tqdm import tqdm
 import re
 import dill as pickle
-from typing import List, Optional
+from typing import Iterable, Iterator, List, Optional, Sequence
 
-from pipeline.search_utils import (
-    lemmatize_text, find_all_entities, extract_entity_sentence
-)
+from pipeline.analysis import DocumentAnalysis
+from pipeline.search_utils import lemmatize_text, build_lemma_warm_set
+from pipeline.sentence_store import SentenceEmbeddingStore
 
 text_lemmatizer = lambda text: lemmatize_text(text)
 
@@ -36,6 +39,58 @@ class Appearance:
         return str(self.__dict__)
 
 
+class PostingList:
+    """
+    Documents a term appears in: parallel arrays of doc ids and frequencies,
+    kept sorted by doc id.
+    """
+
+    def __init__(self, doc_ids=None, frequencies=None):
+        self.doc_ids = doc_ids if doc_ids is not None else array('i')
+        self.frequencies = frequencies if frequencies is not None else array('i')
+
+    @classmethod
+    def from_appearances(cls, appearances: List[Appearance]) -> 'PostingList':
+        posting_list = cls()
+        for appearance in appearances:
+            posting_list.append(appearance.docId, appearance.frequency)
+        return posting_list
+
+    def __repr__(self):
+        """
+        String representation of the PostingList object
+        """
+        return str(list(zip(self.doc_ids, self.frequencies)))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        for doc_id, frequency in zip(self.doc_ids, self.frequencies):
+            yield Appearance(doc_id, frequency)
+
+    def append(self, docId: int, frequency: int) -> None:
+        """
+        Adds a document, amortized O(1) when doc ids come in increasing order.
+        """
+        if not self.doc_ids or self.doc_ids[-1] < docId:
+            self.doc_ids.append(docId)
+            self.frequencies.append(frequency)
+            return
+        position = bisect_left(self.doc_ids, docId)
+        if position < len(self.doc_ids) and self.doc_ids[position] == docId:
+            self.frequencies[position] = frequency
+        else:
+            self.doc_ids.insert(position, docId)
+            self.frequencies.insert(position, frequency)
+
+    def remove(self, docId: int) -> None:
+        position = bisect_left(self.doc_ids, docId)
+        if position < len(self.doc_ids) and self.doc_ids[position] == docId:
+            del self.doc_ids[position]
+            del self.frequencies[position]
+
+
 class Database:
     """
     In memory database representing the already indexed documents.
@@ -72,17 +127,122 @@ class Database:
         return self.db.keys()
 
 
+def analyze_document(document: dict, raw_entities_col_name: str,
+                     entity_lemmatizer=text_lemmatizer,
+                     sentence_store: Optional[SentenceEmbeddingStore] = None) -> dict:
+    """
+    Adds the entity contexts, their sentence ids (when a sentence store is
+    given), the text length and the entity frequency to the document.
+    """
+    analysis = DocumentAnalysis(document['text'], entity_lemmatizer,
+                                raw_entities=document[raw_entities_col_name])
+    document['entity_context'] = {
+        entity: list(sentences)
+        for entity, sentences in analysis.entity_context.items()
+    }
+    if sentence_store is not None:
+        add_entity_context_ids(document, sentence_store)
+    document['text_len'] = len(document['text'].split())
+    document['entity_frequency'] = analysis.entity_frequency
+    return document
+
+
+def add_entity_context_ids(document: dict,
+                           sentence_store: SentenceEmbeddingStore) -> None:
+    document['entity_context_ids'] = {
+        entity: [sentence_store.add(sentence) for sentence in sentences]
+        for entity, sentences in document['entity_context'].items()
+    }
+
+
+class IndexShard:
+    """
+    Partial index of a contiguous doc id range built by a worker process:
+    analyzed documents, postings, document frequencies and lengths.
+    Sentence ids are not assigned, the merging process owns the store.
+    """
+    def __init__(self, start_id: int):
+        self.start_id = start_id
+        self.documents = []
+        self.postings = dict()
+        self.document_frequency = Counter()
+        self.document_len = array('i')
+        self.entity_words = Counter()
+
+    def add_document(self, document: dict, raw_entities_col_name: str) -> None:
+        for entity, frequency in document['entity_frequency'].items():
+            doc_ids, frequencies = self.postings.setdefault(
+                entity, (array('i'), array('i')))
+            doc_ids.append(document['id'])
+            frequencies.append(frequency)
+            self.document_frequency[entity] += 1
+        self.document_len.append(document['text_len'])
+        self.entity_words.update(word for raw_entity in document[raw_entities_col_name]
+                                 for word in raw_entity.split())
+        self.documents.append(document)
+
+
+def build_shard(start_id: int, documents: List[dict],
+                raw_entities_col_name: str) -> IndexShard:
+    shard = IndexShard(start_id)
+    for offset, document in enumerate(documents):
+        document['id'] = start_id + offset
+        analyze_document(document, raw_entities_col_name)
+        shard.add_document(document, raw_entities_col_name)
+    return shard
+
+
+def iter_shards(batches: Iterable[List[dict]], raw_entities_col_name: str,
+                workers: int) -> Iterator[IndexShard]:
+    """
+    Builds the shards of consecutive batches in a process pool and yields
+    them in batch order, so doc ids don't depend on scheduling. At most
+    2 * workers batches are in flight.
+    """
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        start_id = 0
+        for batch in batches:
+            pending.append(pool.apply_async(
+                build_shard, (start_id, batch, raw_entities_col_name)))
+            start_id += len(batch)
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def calculate_idf(document_frequency: Sequence[int], n_documents: int) -> np.ndarray:
+    document_frequency = np.asarray(document_frequency, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        return np.log((n_documents - document_frequency) / document_frequency)
+
+
 class InvertedIndex:
     """
     Inverted Index class.
     """
     def __init__(self, db: Database,
                  entity_lemmatizer=text_lemmatizer,
-                 entity_context_len=10):
+                 entity_context_len=10,
+                 sentence_store: Optional[SentenceEmbeddingStore] = None):
         self.index = dict()
         self.db = db
+        self.sentence_store = sentence_store if sentence_store is not None \
+            else SentenceEmbeddingStore()
+        # statistics, counters are updated on every add / remove and the
+        # derived tables are refreshed by calculate_statistics
+        self.document_frequency = defaultdict(int)
+        self.document_len = array('i')
+        self.total_document_len = 0
+        self.avg_document_len = 0
+        self.idf = dict()
+        self.length_norm = np.zeros(0)
         self.entity_lemmatizer = entity_lemmatizer
         self.entity_context_len = entity_context_len
+        # word -> normal form of the most frequent entity words, preloaded
+        # into the lemmatizer cache when the index is served
+        self.lemma_warm_set = dict()
 
     def __repr__(self):
         """
@@ -90,44 +250,89 @@ class InvertedIndex:
         """
         return str(self.index)
 
-    def index_document(self, document: dict, raw_entities_col_name: str) -> dict:
+    def index_document(self, document: dict, raw_entities_col_name: str,
+                       update_statistics: bool = False) -> dict:
         """
         Process a given document, save it to the DB and update the index.
         entities_alphabet: key is a normalized entity, value - raw entities' set
+        update_statistics: refresh idf and length tables right away, batch
+        builds call calculate_statistics once at the end instead.
         """
-        appearances_dict = defaultdict(int)
-        document['entity_context'] = defaultdict(set)
+        analyze_document(document, raw_entities_col_name,
+                         self.entity_lemmatizer, self.sentence_store)
         # Dictionary with each term and the frequency it appears in the text.
-        for raw_entity in document[raw_entities_col_name]:
-            normalized_entity = self.entity_lemmatizer(raw_entity)
-            for entity_idx in find_all_entities(document['text'], raw_entity):
-                entity_frequency = appearances_dict[normalized_entity].frequency if\
-                    normalized_entity in appearances_dict else 0
-                appearances_dict[normalized_entity] = Appearance(document['id'],
-                                                             entity_frequency + 1)
-                entity_context = extract_entity_sentence(document['text'],
-                                                          entity_idx)
-                document['entity_context'][normalized_entity].add(entity_context)
+        entity_frequency = document['entity_frequency']
         document['embedding'] =\
             torch.tensor(document['rubert-base-cased-sentence_embedding'])
-        document['entity_context'] = dict(document['entity_context'])
-        document['text_len'] = len(document['text'].split())
-        document['entity_frequency'] =\
-            Counter({key: appearance.frequency for
-                     key, appearance in appearances_dict.items()})
         # Update the inverted index
-        update_dict = { key: [appearance]
-                       if key not in self.index
-                       else self.index[key] + [appearance]
-                       for (key, appearance) in appearances_dict.items() }
-        self.index.update(update_dict)
+        for key, frequency in entity_frequency.items():
+            if key not in self.index:
+                self.index[key] = PostingList()
+            self.index[key].append(document['id'], frequency)
         # Add the document into the database
         self.db.add(document)
+        self.add_document_statistics(document)
+        if update_statistics:
+            self.calculate_statistics()
         return document
 
+    def add_shard(self, shard: IndexShard) -> None:
+        """
+        Merges a partial index of build_shard. Shards must be merged in doc
+        id order and follow the documents already in the index.
+        """
+        for document in shard.documents:
+            add_entity_context_ids(document, self.sentence_store)
+            document['embedding'] =\
+                torch.tensor(document['rubert-base-cased-sentence_embedding'])
+            self.db.add(document)
+        for entity, (doc_ids, frequencies) in shard.postings.items():
+            if entity not in self.index:
+                self.index[entity] = PostingList()
+            self.index[entity].doc_ids.extend(doc_ids)
+            self.index[entity].frequencies.extend(frequencies)
+        for entity, document_frequency in shard.document_frequency.items():
+            self.document_frequency[entity] += document_frequency
+        self.document_len.extend(shard.document_len)
+        self.total_document_len += sum(shard.document_len)
+
+    def remove_document(self, docId: int,
+                        update_statistics: bool = True) -> Optional[dict]:
+        """
+        Removes a document from the DB, its postings and the statistics.
+        Indexes opened from an index directory are read-only, a
+        segmented_index.SegmentedIndex over them removes documents instead.
+        """
+        if not hasattr(self.db, 'remove'):
+            raise TypeError(f"{self.db} is read-only, wrap the index in a "
+                            f"SegmentedIndex to remove documents")
+        document = self.db.remove(docId)
+        if document is None:
+            return None
+        for entity in document['entity_frequency']:
+            self.index[entity].remove(docId)
+            self.document_frequency[entity] -= 1
+            if not self.document_frequency[entity]:
+                del self.index[entity]
+                del self.document_frequency[entity]
+                self.idf.pop(entity, None)
+        self.total_document_len -= self.document_len[docId]
+        self.document_len[docId] = 0
+        if update_statistics:
+            self.calculate_statistics()
+        return document
+
+    def add_document_statistics(self, document: dict) -> None:
+        for entity in document['entity_frequency']:
+            self.document_frequency[entity] += 1
+        if len(self.document_len) <= document['id']:
+            self.document_len.extend([0] * (document['id'] + 1 - len(self.document_len)))
+        self.total_document_len += document['text_len'] - self.document_len[document['id']]
+        self.document_len[document['id']] = document['text_len']
+
     def lookup_query(self, normalized_entities: set) -> dict:
         """
-        Returns the dictionary of terms with their correspondent Appearances.
+        Returns the dictionary of terms with their correspondent PostingLists.
         This is a very naive search since it will just split the terms and show
         the documents where they appear.
         """
@@ -140,45 +345,157 @@ class InvertedIndex:
             self.document_frequency[entity] += len(self.index[entity])
 
     def calculate_avg_document_len(self):
-        self.avg_document_len = 0
+        self.document_len = array('i')
         for doc_id in self.db.keys():
-            self.avg_document_len += self.db.get(doc_id)['text_len'] / len(self.db)
+            if len(self.document_len) <= doc_id:
+                self.document_len.extend([0] * (doc_id + 1 - len(self.document_len)))
+            self.document_len[doc_id] = self.db.get(doc_id)['text_len']
+        self.total_document_len = sum(self.document_len)
+        self.avg_document_len = self.total_document_len / len(self.db) \
+            if len(self.db) else 0
+
+    def calculate_statistics(self):
+        """
+        Refreshes the idf table, the average document length and the
+        per-document length normalization (doc_len / avg_len) from the
+        document frequency and length counters.
+        """
+        n_documents = len(self.db)
+        self.avg_document_len = self.total_document_len / n_documents \
+            if n_documents else 0
+        entities = list(self.document_frequency)
+        idf = calculate_idf([self.document_frequency[entity] for entity in entities],
+                            n_documents)
+        self.idf = dict(zip(entities, idf.tolist()))
+        self.length_norm = np.asarray(self.document_len, dtype=np.float64) / \
+            self.avg_document_len if self.avg_document_len else \
+            np.zeros(len(self.document_len))
 
     def get_corpus_embeddings(self):
-
+        if getattr(self.db, 'embeddings', None) is not None:
+            return list(self.db.keys()), torch.from_numpy(self.db.embeddings)
         doc_ids = list(self.db.keys())
         return doc_ids, torch.stack([self.db.get(doc_id)['embedding']
                                      for doc_id in doc_ids])
 
 
 def create_index(document_collection: List[dict],
-                 raw_entity_col_name: str='raw_entity') -> InvertedIndex:
+                 raw_entity_col_name: str='raw_entity',
+                 workers: int = 1,
+                 shard_size: int = 1024) -> InvertedIndex:
+    """
+    workers > 1: documents are analyzed in shards of shard_size by worker
+    processes, the merged index is the same as the sequential one.
+    """
     db = Database()
     index = InvertedIndex(db)
 
+    if workers > 1:
+        batches = (document_collection[start:start + shard_size]
+                   for start in range(0, len(document_collection), shard_size))
+        entity_words = Counter()
+        for shard in tqdm(iter_shards(batches, raw_entity_col_name, workers),
+                          total=-(-len(document_collection) // shard_size)):
+            index.add_shard(shard)
+            entity_words.update(shard.entity_words)
+        index.calculate_statistics()
+        index.lemma_warm_set = build_lemma_warm_set(entity_words)
+        return index
+
     doc_id = 0
     for document in tqdm(document_collection):
         document['id'] = doc_id
         index.index_document(document, raw_entity_col_name)
         doc_id += 1
-    index.calculate_document_frequency_per_entity()
-    index.calculate_avg_document_len()
+    index.calculate_statistics()
+    index.lemma_warm_set = build_lemma_warm_set(
+        word for document in document_collection
+        for raw_entity in document[raw_entity_col_name]
+        for word in raw_entity.split())
     return index
 
 
-def main(index_path: str):
+def embed_entity_context(index: InvertedIndex,
+                         model_name: str = "DeepPavlov/rubert-base-cased-sentence",
+                         dtype: str = 'float32') -> None:
+    embed_sentences(index.sentence_store, model_name, dtype)
+
+
+def embed_sentences(sentence_store: SentenceEmbeddingStore,
+                    model_name: str = "DeepPavlov/rubert-base-cased-sentence",
+                    dtype: str = 'float32') -> None:
+    from pipeline.models import registry
+    from pipeline.scorer import SentenceBertScorer
+
+    scorer = SentenceBertScorer(*registry.get_encoder(model_name))
+    sentence_store.dtype = dtype
+    sentence_store.embed(scorer.encode_sentences)
+
+
+def main(index_path: str, output: str = "index", index_format: str = "mmap",
+         sentence_embeddings: bool = False,
+         sentence_embeddings_dtype: str = 'float32',
+         tonality: bool = False,
+         streaming: bool = False,
+         run_size: int = 1000000,
+         workers: int = 1):
+    if streaming:
+        if index_format != "mmap":
+            raise ValueError("Streaming build writes the mmap format only")
+        from pipeline.index_builder import build_index
+        build_index(index_path, output, 'raw_entity', run_size=run_size,
+                    sentence_embeddings=sentence_embeddings,
+                    sentence_embeddings_dtype=sentence_embeddings_dtype,
+                    tonality=tonality, workers=workers)
+        return
     with open(index_path, "rt") as f:
         index_data = json.load(f)
-    index = create_index(index_data, 'raw_entity')
+    if tonality:
+        from pipeline.tonality import add_tonality
+        add_tonality(index_data)
+    index = create_index(index_data, 'raw_entity', workers=workers)
+    if sentence_embeddings:
+        embed_entity_context(index, dtype=sentence_embeddings_dtype)
 
-    with open("index.pickle", "wb") as f:
-        pickle.dump(index, f)
+    if index_format == "mmap":
+        from pipeline.index_storage import save_index
+        save_index(index, output)
+    else:
+        with open(output, "wb") as f:
+            pickle.dump(index, f)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Parsers")
     parser.add_argument("--index_data", type=str, required=True,
                         help="path to files for index")
+    parser.add_argument("--output", type=str, default="index",
+                        help="path of the built index")
+    parser.add_argument("--format", type=str, default="mmap",
+                        choices=["mmap", "pickle"],
+                        help="memory-mapped index directory or legacy dill pickle")
+    parser.add_argument("--sentence-embeddings", action="store_true",
+                        help="precompute rubert embeddings of entity context sentences")
+    parser.add_argument("--sentence-embeddings-dtype", type=str, default="float32",
+                        choices=["float16", "float32"],
+                        help="dtype of the stored sentence embeddings")
+    parser.add_argument("--tonality", action="store_true",
+                        help="score the tonality of documents that have none")
+    parser.add_argument("--streaming", action="store_true",
+                        help="build incrementally from a JSON / JSON Lines file or "
+                             "a directory of chunks without loading the corpus")
+    parser.add_argument("--run-size", type=int, default=1000000,
+                        help="postings kept in memory before spilling a sorted run")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes analyzing the documents")
 
     args = parser.parse_args()
-    main(index_path=args.index_data)
+    main(index_path=args.index_data,
+         output=args.output,
+         index_format=args.format,
+         sentence_embeddings=args.sentence_embeddings,
+         sentence_embeddings_dtype=args.sentence_embeddings_dtype,
+         tonality=args.tonality,
+         streaming=args.streaming,
+         run_size=args.run_size,
+         workers=args.workers)
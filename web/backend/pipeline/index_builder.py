@@ -0,0 +1,258 @@
+import heapq
+import json
+import os
+import re
+import shutil
+from array import array
+from collections import Counter
+from itertools import groupby, islice
+from typing import Iterable, Iterator, Optional, Tuple
+
+from tqdm import tqdm
+
+from pipeline.index import (
+    IndexShard, add_entity_context_ids, analyze_document, calculate_idf,
+    embed_sentences, iter_shards, text_lemmatizer
+)
+from pipeline.index_storage import IndexWriter
+from pipeline.search_utils import build_lemma_warm_set
+from pipeline.sentence_store import SentenceEmbeddingStore
+
+SEPARATOR_RE = re.compile(r'[\s,]*')
+
+
+def iter_json_array(f, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """
+    Decodes the items of a top level JSON array one by one, reading the
+    file in chunks.
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    eof = not buffer
+    # leading whitespace may span several chunks
+    while not eof and SEPARATOR_RE.match(buffer).end() == len(buffer):
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+    pos = SEPARATOR_RE.match(buffer).end()
+    if buffer[pos:pos + 1] != '[':
+        raise ValueError(f"Expected a JSON array in {f.name}")
+    pos += 1
+    while True:
+        pos = SEPARATOR_RE.match(buffer, pos).end()
+        if buffer[pos:pos + 1] == ']':
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+
+
+def iter_documents(path: str) -> Iterator[dict]:
+    """
+    Documents of a JSON Lines file, a JSON array file or a directory of
+    such chunks (in name order).
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(('.json', '.jsonl')):
+                yield from iter_documents(os.path.join(path, name))
+        return
+    with open(path, "rt") as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(f)
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class PostingRuns:
+    """
+    (entity, doc id, frequency) postings buffered up to run_size, then
+    sorted and spilled to a run file. merge streams the posting list of
+    every entity in entity order, doc ids ascending.
+    """
+    def __init__(self, path: str, run_size: int = 1000000):
+        self.path = path
+        self.run_size = run_size
+        self.buffer = []
+        self.runs = []
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, entity: str, doc_id: int, frequency: int) -> None:
+        self.buffer.append((entity, doc_id, frequency))
+        if len(self.buffer) >= self.run_size:
+            self.spill()
+
+    def spill(self) -> None:
+        if not self.buffer:
+            return
+        self.buffer.sort()
+        run_path = os.path.join(self.path, f'run_{len(self.runs):05d}.jsonl')
+        with open(run_path, 'wt') as f:
+            for posting in self.buffer:
+                f.write(json.dumps(posting, ensure_ascii=False))
+                f.write('\n')
+        self.runs.append(run_path)
+        self.buffer = []
+
+    @staticmethod
+    def read_run(run_path: str) -> Iterator[list]:
+        with open(run_path, 'rt') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def merge(self) -> Iterator[Tuple[str, array, array]]:
+        self.spill()
+        postings = heapq.merge(*(self.read_run(run_path) for run_path in self.runs))
+        for entity, entity_postings in groupby(postings, key=lambda posting: posting[0]):
+            doc_ids, frequencies = array('i'), array('i')
+            for _, doc_id, frequency in entity_postings:
+                doc_ids.append(doc_id)
+                frequencies.append(frequency)
+            yield entity, doc_ids, frequencies
+
+    def remove(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class StreamingIndexBuilder:
+    """
+    Builds the memory-mapped index one document at a time: the document
+    columns and the embedding matrix are appended to the IndexWriter files,
+    postings go to sorted runs merged on close. Memory holds the run
+    buffer and per-document lengths instead of the corpus.
+    sentence_store: registers the entity context sentences for sentence
+    embeddings, the unique sentences are then kept in memory.
+    """
+    def __init__(self, path: str,
+                 raw_entity_col_name: str = 'raw_entity',
+                 entity_lemmatizer=text_lemmatizer,
+                 run_size: int = 1000000,
+                 sentence_store: Optional[SentenceEmbeddingStore] = None,
+                 entity_context_len: int = 10):
+        self.writer = IndexWriter(path)
+        self.runs = PostingRuns(os.path.join(self.writer.tmp_path, 'runs'), run_size)
+        self.raw_entity_col_name = raw_entity_col_name
+        self.entity_lemmatizer = entity_lemmatizer
+        self.sentence_store = sentence_store
+        self.entity_context_len = entity_context_len
+        self.document_frequency = Counter()
+        self.document_len = array('i')
+        self.entity_words = Counter()
+
+    def add_document(self, document: dict) -> None:
+        document['id'] = self.writer.n_documents
+        analyze_document(document, self.raw_entity_col_name,
+                         self.entity_lemmatizer, self.sentence_store)
+        self.add_analyzed_document(document)
+
+    def add_analyzed_document(self, document: dict) -> None:
+        """
+        Adds a document index.analyze_document already ran on, its id must
+        be the next doc id.
+        """
+        for entity, frequency in document['entity_frequency'].items():
+            self.runs.add(entity, document['id'], frequency)
+            self.document_frequency[entity] += 1
+        self.document_len.append(document['text_len'])
+        self.entity_words.update(word for raw_entity in document[self.raw_entity_col_name]
+                                 for word in raw_entity.split())
+        self.writer.add_document(document)
+
+    def add_deleted(self, doc_id: int) -> None:
+        """
+        Keeps the doc id of a deleted document, see IndexWriter.add_deleted.
+        """
+        self.writer.add_deleted(doc_id)
+        self.document_len.append(0)
+
+    def add_shard(self, shard: IndexShard) -> None:
+        """
+        Merges a partial index of index.build_shard, shards must come in doc
+        id order.
+        """
+        if shard.start_id != self.writer.n_documents:
+            raise ValueError(f"Shard starts at doc id {shard.start_id}, "
+                             f"expected {self.writer.n_documents}")
+        for document in shard.documents:
+            if self.sentence_store is not None:
+                add_entity_context_ids(document, self.sentence_store)
+            self.writer.add_document(document)
+        for entity, (doc_ids, frequencies) in shard.postings.items():
+            for doc_id, frequency in zip(doc_ids, frequencies):
+                self.runs.add(entity, doc_id, frequency)
+        self.document_frequency.update(shard.document_frequency)
+        self.document_len.extend(shard.document_len)
+        self.entity_words.update(shard.entity_words)
+
+    def close(self, **meta) -> str:
+        """
+        meta: extra meta.json fields.
+        """
+        self.writer.write_sorted_postings(self.runs.merge())
+        self.runs.remove()
+        n_documents = len(self.document_len) - len(self.writer.deleted)
+        idf = calculate_idf([self.document_frequency[entity]
+                             for entity in self.writer.vocabulary], n_documents)
+        self.writer.write_statistics(dict(zip(self.writer.vocabulary, idf.tolist())),
+                                     self.document_len,
+                                     sum(self.document_len) / n_documents
+                                     if n_documents else 0)
+        if self.sentence_store is not None:
+            self.writer.write_sentence_embeddings(self.sentence_store.embeddings)
+        self.writer.write_lemma_warm_set(build_lemma_warm_set(self.entity_words))
+        return self.writer.close(entity_context_len=self.entity_context_len, **meta)
+
+
+def build_index(input_path: str, output: str,
+                raw_entity_col_name: str = 'raw_entity',
+                run_size: int = 1000000,
+                batch_size: int = 1024,
+                sentence_embeddings: bool = False,
+                sentence_embeddings_dtype: str = 'float32',
+                tonality: bool = False,
+                workers: int = 1) -> str:
+    """
+    Streaming counterpart of index.create_index + index_storage.save_index,
+    returns the version of the written index.
+    workers > 1: batches are analyzed by worker processes (index.iter_shards).
+    """
+    builder = StreamingIndexBuilder(
+        output, raw_entity_col_name, run_size=run_size,
+        sentence_store=SentenceEmbeddingStore() if sentence_embeddings else None)
+
+    def batches():
+        for batch in iter_batches(tqdm(iter_documents(input_path)), batch_size):
+            if tonality:
+                from pipeline.tonality import add_tonality
+                add_tonality(batch, batch_size)
+            yield batch
+
+    if workers > 1:
+        for shard in iter_shards(batches(), raw_entity_col_name, workers):
+            builder.add_shard(shard)
+    else:
+        for batch in batches():
+            for document in batch:
+                builder.add_document(document)
+    if sentence_embeddings:
+        embed_sentences(builder.sentence_store, dtype=sentence_embeddings_dtype)
+    return builder.close()
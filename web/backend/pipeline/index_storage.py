@@ -0,0 +1,529 @@
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from functools import lru_cache
+
+import json
+import os
+import shutil
+import struct
+import time
+import uuid
+import numpy as np
+import torch
+import dill as pickle
+from typing import Iterable, Optional, Sequence, Tuple
+
+from pipeline.index import InvertedIndex, PostingList
+from pipeline.sentence_store import SentenceEmbeddingStore
+
+FORMAT_VERSION = 1
+EMBEDDING_COLUMNS = ('embedding', 'rubert-base-cased-sentence_embedding')
+JSON_DECODERS = {'entity_frequency': Counter}
+NPY_HEADER_SIZE = 128
+
+
+class NpyStreamWriter:
+    """
+    Appends rows straight into a .npy file of unknown length: the header
+    space is reserved up front and filled with the final shape on close.
+    """
+    def __init__(self, path: str, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.file = open(path, 'wb')
+        self.file.write(b'\0' * NPY_HEADER_SIZE)
+        self.n_rows = 0
+        self.row_shape = None
+        # zero rows requested before the row shape is known
+        self.pending_zero_rows = 0
+
+    def write(self, rows: np.ndarray) -> None:
+        """
+        rows: (n, *row_shape) array.
+        """
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if self.row_shape is None:
+            self.row_shape = rows.shape[1:]
+            self.write_zeros(0)
+        self.file.write(rows.tobytes())
+        self.n_rows += len(rows)
+
+    def write_zeros(self, n_rows: int) -> None:
+        self.pending_zero_rows += n_rows
+        if self.row_shape is None:
+            return
+        self.file.write(np.zeros((self.pending_zero_rows, *self.row_shape),
+                                 dtype=self.dtype).tobytes())
+        self.n_rows += self.pending_zero_rows
+        self.pending_zero_rows = 0
+
+    def close(self, row_shape: Tuple[int, ...] = ()) -> None:
+        if self.row_shape is None:
+            self.row_shape = row_shape
+            self.write_zeros(0)
+        shape = (self.n_rows, *self.row_shape)
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                       'fortran_order': False, 'shape': shape})
+        magic = b'\x93NUMPY\x01\x00'
+        header_len = NPY_HEADER_SIZE - len(magic) - 2
+        header = header.ljust(header_len - 1).encode('latin1') + b'\n'
+        self.file.seek(0)
+        self.file.write(magic + struct.pack('<H', header_len) + header)
+        self.file.close()
+
+
+class BlobColumnWriter:
+    """
+    Appends JSON encoded values of one document column into a single blob,
+    remembering the end offset of every value. Empty value means missing.
+    """
+    def __init__(self, path: str, n_documents: int = 0):
+        self.path = path
+        self.blob = open(f'{path}.bin', 'wb')
+        self.offsets = array('q', [0] * (n_documents + 1))
+
+    def pad_to(self, n_documents: int) -> None:
+        while len(self.offsets) < n_documents + 1:
+            self.offsets.append(self.offsets[-1])
+
+    def append(self, value) -> None:
+        data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.blob.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self) -> None:
+        self.blob.close()
+        np.save(f'{self.path}.offsets.npy', np.frombuffer(self.offsets, dtype=np.int64))
+
+
+class IndexWriter:
+    """
+    Writes the index directory:
+        meta.json                  format version, build version, statistics
+        vocabulary.json            entities, row i owns postings_offsets[i:i + 2]
+        postings_*.npy             flat posting arrays sorted by entity
+        idf.npy                    idf per vocabulary row
+        document_len.npy           text length and length normalization
+        length_norm.npy            (doc_len / avg_len) per doc id
+        documents/<column>.bin     columnar document store
+        embeddings.npy             (n_documents, dim) float32 matrix
+        sentence_embeddings.npy    entity context sentence embeddings
+        lemmas.json                lemmatizer warm set
+        deleted.npy                doc ids of deleted documents (gaps)
+        document_entity_frequency.npy
+                                   sum of the entity frequencies per doc id
+        presence_indptr.npy        doc x vocabulary row CSR of the 'entity'
+        presence_indices.npy       field, for intersection scoring
+    Everything is written into a temporary directory of its own. On `close`
+    it becomes the versioned directory `<path>-<version>` and `path`, a
+    symlink, is switched to it with one atomic rename: readers always find
+    a complete index at `path`, the previous version stays until the next
+    build for readers that resolved it just before the switch.
+    """
+    def __init__(self, path: str):
+        self.path = os.path.normpath(path)
+        self.tmp_path = f'{self.path}.tmp-{uuid.uuid4().hex[:8]}'
+        os.makedirs(os.path.join(self.tmp_path, 'documents'))
+        self.columns = dict()
+        self.n_documents = 0
+        self.embeddings = NpyStreamWriter(
+            os.path.join(self.tmp_path, 'embeddings.npy'), np.float32)
+        self.vocabulary = []
+        self.meta = dict()
+        self.deleted = array('i')
+        self.document_entity_frequency = array('i')
+
+    def add_document(self, document: dict) -> None:
+        if document['id'] != self.n_documents:
+            raise ValueError(f"Documents must be added in id order, "
+                             f"expected {self.n_documents}, got {document['id']}")
+        for column, value in document.items():
+            if column == 'id' or column in EMBEDDING_COLUMNS:
+                continue
+            if column not in self.columns:
+                self.columns[column] = BlobColumnWriter(
+                    os.path.join(self.tmp_path, 'documents', column),
+                    self.n_documents)
+            self.columns[column].pad_to(self.n_documents)
+            self.columns[column].append(value)
+        embedding = document.get('embedding')
+        if embedding is None:
+            embedding = document['rubert-base-cased-sentence_embedding']
+        self.embeddings.write(np.asarray(embedding, dtype=np.float32)[None])
+        self.document_entity_frequency.append(
+            sum(document.get('entity_frequency', dict()).values()))
+        self.n_documents += 1
+
+    def add_deleted(self, doc_id: int) -> None:
+        """
+        Keeps the doc id of a deleted document: no columns, a zero
+        embedding, the next document keeps its id.
+        """
+        if doc_id != self.n_documents:
+            raise ValueError(f"Documents must be added in id order, "
+                             f"expected {self.n_documents}, got {doc_id}")
+        self.embeddings.write_zeros(1)
+        self.deleted.append(doc_id)
+        self.document_entity_frequency.append(0)
+        self.n_documents += 1
+
+    def write_postings(self, postings: Iterable[Tuple[str, Sequence[int], Sequence[int]]]) -> None:
+        """
+        postings: (entity, doc ids, frequencies) in any entity order.
+        """
+        self.write_sorted_postings(sorted(postings, key=lambda posting: posting[0]))
+
+    def write_sorted_postings(self, postings: Iterable[Tuple[str, Sequence[int], Sequence[int]]]) -> None:
+        """
+        postings: (entity, doc ids, frequencies) sorted by entity, streamed
+        to disk, only the vocabulary and its offsets are kept in memory.
+        """
+        vocabulary = []
+        offsets = array('q', [0])
+        doc_ids = NpyStreamWriter(
+            os.path.join(self.tmp_path, 'postings_doc_ids.npy'), np.int32)
+        frequencies = NpyStreamWriter(
+            os.path.join(self.tmp_path, 'postings_frequencies.npy'), np.int32)
+        for entity, entity_doc_ids, entity_frequencies in postings:
+            vocabulary.append(entity)
+            doc_ids.write(np.asarray(entity_doc_ids))
+            frequencies.write(np.asarray(entity_frequencies))
+            offsets.append(offsets[-1] + len(entity_doc_ids))
+        doc_ids.close()
+        frequencies.close()
+        with open(os.path.join(self.tmp_path, 'vocabulary.json'), 'wt') as f:
+            json.dump(vocabulary, f, ensure_ascii=False)
+        np.save(os.path.join(self.tmp_path, 'postings_offsets.npy'),
+                np.frombuffer(offsets, dtype=np.int64))
+        self.vocabulary = vocabulary
+        self.meta['entities'] = len(vocabulary)
+
+    def write_statistics(self, idf: Mapping, document_len: Sequence[int],
+                         avg_document_len: float) -> None:
+        """
+        Must follow write_postings: idf is stored aligned to the vocabulary.
+        """
+        np.save(os.path.join(self.tmp_path, 'idf.npy'),
+                np.array([idf[entity] for entity in self.vocabulary], dtype=np.float64))
+        document_len = np.asarray(document_len, dtype=np.int32)
+        np.save(os.path.join(self.tmp_path, 'document_len.npy'), document_len)
+        np.save(os.path.join(self.tmp_path, 'length_norm.npy'),
+                document_len / avg_document_len if avg_document_len
+                else np.zeros(len(document_len)))
+        self.meta['total_document_len'] = int(document_len.sum())
+        self.meta['avg_document_len'] = avg_document_len
+
+    def write_lemma_warm_set(self, lemma_warm_set: Mapping) -> None:
+        with open(os.path.join(self.tmp_path, 'lemmas.json'), 'wt') as f:
+            json.dump(dict(lemma_warm_set), f, ensure_ascii=False)
+
+    def write_sentence_embeddings(self, embeddings: Optional[np.ndarray]) -> None:
+        if embeddings is not None:
+            np.save(os.path.join(self.tmp_path, 'sentence_embeddings.npy'), embeddings)
+
+    def iter_column(self, column: str) -> Iterable:
+        """
+        Values of a closed document column in doc id order, None if missing.
+        """
+        if column not in self.columns:
+            yield from (None for _ in range(self.n_documents))
+            return
+        path = os.path.join(self.tmp_path, 'documents', column)
+        offsets = np.load(f'{path}.offsets.npy')
+        with open(f'{path}.bin', 'rb') as f:
+            for length in np.diff(offsets).tolist():
+                data = f.read(length)
+                yield json.loads(data.decode('utf-8')) if data else None
+
+    def write_entity_presence(self) -> None:
+        """
+        Must follow write_postings and the columns close: reads the 'entity'
+        column back once and streams its CSR over the vocabulary rows.
+        """
+        entity_rows = {entity: row for row, entity in enumerate(self.vocabulary)}
+        indptr = NpyStreamWriter(
+            os.path.join(self.tmp_path, 'presence_indptr.npy'), np.int64)
+        indices = NpyStreamWriter(
+            os.path.join(self.tmp_path, 'presence_indices.npy'), np.int32)
+        n_indices = 0
+        indptr.write(np.zeros(1))
+        for rows in iter_entity_presence(self.iter_column('entity'), entity_rows):
+            indices.write(rows)
+            n_indices += len(rows)
+            indptr.write(np.array([n_indices]))
+        indptr.close()
+        indices.close()
+
+    def close(self, **meta) -> str:
+        for column in self.columns.values():
+            column.pad_to(self.n_documents)
+            column.close()
+        self.embeddings.close(row_shape=(0,))
+        self.write_entity_presence()
+        np.save(os.path.join(self.tmp_path, 'document_entity_frequency.npy'),
+                np.frombuffer(self.document_entity_frequency, dtype=np.int32))
+        if self.deleted:
+            np.save(os.path.join(self.tmp_path, 'deleted.npy'),
+                    np.frombuffer(self.deleted, dtype=np.int32))
+        self.meta.update(meta)
+        self.meta.update({
+            'format_version': FORMAT_VERSION,
+            'version': f'{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}',
+            'documents': self.n_documents,
+            'deleted': len(self.deleted),
+            'columns': sorted(self.columns),
+        })
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'wt') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        version_path = f"{self.path}-{self.meta['version']}"
+        os.rename(self.tmp_path, version_path)
+        if os.path.isdir(self.path) and not os.path.islink(self.path):
+            # index written before the versioned layout: keep it as a version
+            os.rename(self.path, f'{self.path}-{get_index_version(self.path)}')
+        switch_symlink(self.path, os.path.basename(version_path))
+        remove_old_versions(self.path)
+        return self.meta['version']
+
+
+def iter_entity_presence(entity_lists: Iterable[Optional[list]],
+                         entity_rows: Mapping) -> Iterable[np.ndarray]:
+    """
+    Sorted vocabulary rows of the entities of every document.
+    """
+    for entities in entity_lists:
+        yield np.array(sorted({entity_rows[entity] for entity in entities or ()
+                               if entity in entity_rows}), dtype=np.int32)
+
+
+def switch_symlink(path: str, target: str) -> None:
+    tmp_link = f'{path}.link-{uuid.uuid4().hex[:8]}'
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, path)
+
+
+def get_version_paths(path: str) -> list:
+    """
+    Versioned directories of the index at path, oldest first.
+    """
+    directory, name = os.path.split(os.path.normpath(path))
+    version_paths = [os.path.join(directory, entry)
+                     for entry in os.listdir(directory or '.')
+                     if entry.startswith(f'{name}-') and
+                     os.path.exists(os.path.join(directory, entry, 'meta.json'))]
+    return sorted(version_paths, key=lambda version_path: os.path.getmtime(
+        os.path.join(version_path, 'meta.json')))
+
+
+def remove_old_versions(path: str, keep: int = 2) -> None:
+    """
+    Keeps the served version and the keep - 1 versions before it. Workers
+    serving a removed version keep their open memory maps.
+    """
+    current = os.path.realpath(path)
+    old_paths = [version_path for version_path in get_version_paths(path)
+                 if os.path.realpath(version_path) != current]
+    for version_path in old_paths[:max(len(old_paths) - keep + 1, 0)]:
+        shutil.rmtree(version_path, ignore_errors=True)
+
+
+class MmapPostings(Mapping):
+    """
+    Read-only entity -> postings mapping over the flat posting arrays.
+    """
+    def __init__(self, vocabulary: list, offsets: np.ndarray,
+                 doc_ids: np.ndarray, frequencies: np.ndarray):
+        self.entity_rows = {entity: row for row, entity in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.frequencies = frequencies
+
+    def __getitem__(self, entity: str):
+        row = self.entity_rows[entity]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return PostingList(self.doc_ids[start:end], self.frequencies[start:end])
+
+    def __contains__(self, entity) -> bool:
+        return entity in self.entity_rows
+
+    def __iter__(self):
+        return iter(self.entity_rows)
+
+    def __len__(self):
+        return len(self.entity_rows)
+
+    def __repr__(self):
+        return f'MmapPostings(entities={len(self)})'
+
+
+class RowMapping(Mapping):
+    """
+    Read-only entity -> value mapping over an array aligned to the vocabulary.
+    """
+    def __init__(self, entity_rows: dict, values: np.ndarray):
+        self.entity_rows = entity_rows
+        self.values = values
+
+    def __getitem__(self, entity: str):
+        return self.values[self.entity_rows[entity]].item()
+
+    def __contains__(self, entity) -> bool:
+        return entity in self.entity_rows
+
+    def __iter__(self):
+        return iter(self.entity_rows)
+
+    def __len__(self):
+        return len(self.entity_rows)
+
+
+class MmapDatabase:
+    """
+    Read-only columnar document store. Documents are decoded on demand.
+    Doc ids of deleted documents (gaps) are kept: they count in len and
+    keys, align with the embedding rows, and get returns None for them.
+    """
+    def __init__(self, path: str, columns: list, n_documents: int,
+                 embeddings: np.ndarray, cache_size: int = 4096,
+                 deleted: frozenset = frozenset()):
+        self.path = path
+        self.n_documents = n_documents
+        self.embeddings = embeddings
+        self.deleted = deleted
+        self.columns = {
+            column: (np.memmap(os.path.join(path, f'{column}.bin'), dtype=np.uint8, mode='r')
+                     if os.path.getsize(os.path.join(path, f'{column}.bin')) else b'',
+                     np.load(os.path.join(path, f'{column}.offsets.npy'), mmap_mode='r'))
+            for column in columns
+        }
+        self.get = lru_cache(maxsize=cache_size)(self._get)
+
+    def __repr__(self):
+        return f'MmapDatabase(documents={len(self)})'
+
+    def __len__(self):
+        return self.n_documents
+
+    def _get(self, docId: int) -> Optional[dict]:
+        if not 0 <= docId < self.n_documents or docId in self.deleted:
+            return None
+        document = {'id': docId}
+        for column, (blob, offsets) in self.columns.items():
+            start, end = offsets[docId], offsets[docId + 1]
+            if start == end:
+                continue
+            value = json.loads(bytes(blob[start:end]).decode('utf-8'))
+            document[column] = JSON_DECODERS.get(column, lambda x: x)(value)
+        document['embedding'] = torch.from_numpy(self.embeddings[docId])
+        return document
+
+    def keys(self):
+        return range(self.n_documents)
+
+
+def save_index(index: InvertedIndex, path: str) -> str:
+    writer = IndexWriter(path)
+    for doc_id in sorted(index.db.keys()):
+        writer.add_document(index.db.get(doc_id))
+    writer.write_postings(
+        (entity, posting_list.doc_ids, posting_list.frequencies)
+        for entity, posting_list in index.index.items())
+    writer.write_statistics(index.idf, index.document_len, index.avg_document_len)
+    writer.write_sentence_embeddings(index.sentence_store.embeddings)
+    writer.write_lemma_warm_set(getattr(index, 'lemma_warm_set', dict()))
+    return writer.close(entity_context_len=index.entity_context_len)
+
+
+def load_index(path: str) -> InvertedIndex:
+    # one version even if a build switches the symlink while loading
+    path = os.path.realpath(path)
+    with open(os.path.join(path, 'meta.json'), 'rt') as f:
+        meta = json.load(f)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported index format version "
+                         f"{meta.get('format_version')}, expected {FORMAT_VERSION}")
+    with open(os.path.join(path, 'vocabulary.json'), 'rt') as f:
+        vocabulary = json.load(f)
+    # copy-on-write mapping: pages are shared between workers and torch
+    # accepts the arrays as writable
+    embeddings = np.load(os.path.join(path, 'embeddings.npy'), mmap_mode='c')
+    deleted_path = os.path.join(path, 'deleted.npy')
+    deleted_ids = np.load(deleted_path) if os.path.exists(deleted_path) \
+        else np.zeros(0, dtype=np.int32)
+    db = MmapDatabase(os.path.join(path, 'documents'), meta['columns'],
+                      meta['documents'], embeddings,
+                      deleted=frozenset(deleted_ids.tolist()))
+    sentence_store = SentenceEmbeddingStore()
+    sentence_embeddings_path = os.path.join(path, 'sentence_embeddings.npy')
+    if os.path.exists(sentence_embeddings_path):
+        sentence_store.embeddings = np.load(sentence_embeddings_path, mmap_mode='r')
+        sentence_store.dtype = str(sentence_store.embeddings.dtype)
+
+    index = InvertedIndex(db, entity_context_len=meta.get('entity_context_len', 10),
+                          sentence_store=sentence_store)
+    offsets = np.load(os.path.join(path, 'postings_offsets.npy'), mmap_mode='r')
+    index.index = MmapPostings(
+        vocabulary, offsets,
+        np.load(os.path.join(path, 'postings_doc_ids.npy'), mmap_mode='r'),
+        np.load(os.path.join(path, 'postings_frequencies.npy'), mmap_mode='r'))
+    index.document_frequency = RowMapping(index.index.entity_rows, np.diff(offsets))
+    index.idf = RowMapping(index.index.entity_rows,
+                           np.load(os.path.join(path, 'idf.npy'), mmap_mode='r'))
+    index.document_len = np.load(os.path.join(path, 'document_len.npy'), mmap_mode='r')
+    index.length_norm = np.load(os.path.join(path, 'length_norm.npy'), mmap_mode='r')
+    index.total_document_len = meta['total_document_len']
+    index.avg_document_len = meta['avg_document_len']
+    index.version = meta['version']
+    index.deleted_ids = deleted_ids
+    # scoring_engine matrices, missing in indexes built before them
+    presence_path = os.path.join(path, 'presence_indptr.npy')
+    if os.path.exists(presence_path):
+        index.presence_indptr = np.load(presence_path, mmap_mode='r')
+        index.presence_indices = np.load(os.path.join(path, 'presence_indices.npy'),
+                                         mmap_mode='r')
+        index.document_entity_frequency = np.load(
+            os.path.join(path, 'document_entity_frequency.npy'), mmap_mode='r')
+    # position of a merged index in the delta log of its lineage, the
+    # updates after it are replayed on top (segmented_index, delta_log)
+    index.delta_lineage = meta.get('delta_lineage', meta['version'])
+    index.delta_seq = meta.get('delta_seq', 0)
+    lemmas_path = os.path.join(path, 'lemmas.json')
+    if os.path.exists(lemmas_path):
+        with open(lemmas_path, 'rt') as f:
+            index.lemma_warm_set = json.load(f)
+    return index
+
+
+def get_index_meta(path: str) -> dict:
+    with open(os.path.join(path, 'meta.json'), 'rt') as f:
+        return json.load(f)
+
+
+def get_index_version(path: str) -> str:
+    """
+    Version of the index at path without opening it: the build version of
+    an index directory or the modification time of a pickle.
+    """
+    if os.path.isdir(path):
+        return get_index_meta(path)['version']
+    return f'pickle-{os.path.getmtime(path):.0f}'
+
+
+def open_index(path: str) -> InvertedIndex:
+    """
+    Opens a memory-mapped index directory or a legacy dill pickle.
+    """
+    if os.path.isdir(path):
+        return load_index(path)
+    with open(path, "rb") as f:
+        index = pickle.load(f)
+    # indexes pickled before PostingList keep lists of Appearance objects
+    index.index = {entity: posting_list if isinstance(posting_list, PostingList)
+                   else PostingList.from_appearances(posting_list)
+                   for entity, posting_list in index.index.items()}
+    if not getattr(index, 'idf', None):
+        index.calculate_document_frequency_per_entity()
+        index.calculate_avg_document_len()
+        index.calculate_statistics()
+    index.version = get_index_version(path)
+    return index
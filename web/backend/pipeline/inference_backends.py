@@ -0,0 +1,141 @@
+import os
+from typing import List, Optional, Tuple, Union
+
+import torch
+
+INFERENCE_BACKENDS = ('eager', 'quantized', 'onnx')
+
+
+class EagerBackend:
+    """
+    Plain PyTorch eager model, returns the HF model outputs.
+    """
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, **tokens) -> dict:
+        with torch.no_grad():
+            return self.model(**tokens)
+
+
+class DynamicQuantizedBackend(EagerBackend):
+    """
+    Linear layers quantized to int8 with torch dynamic quantization,
+    activations are quantized on the fly. inplace=True quantizes a model
+    shared with other components instead of keeping a float copy.
+    """
+    def __init__(self, model, inplace: bool = False):
+        super().__init__(torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=inplace))
+
+
+class BertOutputs(torch.nn.Module):
+    """
+    Tuple outputs wrapper for the ONNX export.
+    """
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        outputs = self.model(input_ids=input_ids,
+                             attention_mask=attention_mask,
+                             token_type_ids=token_type_ids,
+                             return_dict=True)
+        return outputs['last_hidden_state'], outputs['pooler_output']
+
+
+def export_onnx(model, tokenizer, path: str, opset_version: int = 13) -> None:
+    """
+    Exports to a temporary file renamed to path when complete: the server
+    workers starting together may export at once, none of them opens a
+    half written graph.
+    """
+    tokens = tokenizer(['Москва признана первой среди европейских городов.'],
+                       return_tensors='pt')
+    dynamic_axes = {0: 'batch', 1: 'sequence'}
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with torch.no_grad():
+        torch.onnx.export(
+            BertOutputs(model).eval(),
+            (tokens['input_ids'], tokens['attention_mask'], tokens['token_type_ids']),
+            tmp_path,
+            input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+            output_names=['last_hidden_state', 'pooler_output'],
+            dynamic_axes={'input_ids': dynamic_axes,
+                          'attention_mask': dynamic_axes,
+                          'token_type_ids': dynamic_axes,
+                          'last_hidden_state': dynamic_axes,
+                          'pooler_output': {0: 'batch'}},
+            opset_version=opset_version)
+    os.replace(tmp_path, path)
+
+
+class OnnxBackend:
+    """
+    Model exported to ONNX (once, cached at onnx_path) and run with
+    onnxruntime on CPU.
+    """
+    def __init__(self, model, tokenizer, onnx_path: str,
+                 intra_op_threads: Optional[int] = None):
+        import onnxruntime
+
+        if not os.path.exists(onnx_path):
+            export_onnx(model, tokenizer, onnx_path)
+        options = onnxruntime.SessionOptions()
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(
+            onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [session_input.name
+                            for session_input in self.session.get_inputs()]
+
+    def __call__(self, **tokens) -> dict:
+        feeds = {name: tokens[name].cpu().numpy() for name in self.input_names}
+        last_hidden_state, pooler_output = self.session.run(
+            ['last_hidden_state', 'pooler_output'], feeds)
+        return {'last_hidden_state': torch.from_numpy(last_hidden_state),
+                'pooler_output': torch.from_numpy(pooler_output)}
+
+
+class BackendSentenceEncoder:
+    """
+    SentenceTransformer.encode replacement on top of a backend: mean pooling
+    of the token embeddings, as the sentence transformer of rubert does.
+    """
+    def __init__(self, backend, tokenizer, max_seq_length: int = 512):
+        self.backend = backend
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+
+    def encode(self, sentences: Union[str, List[str]], convert_to_tensor: bool = True,
+               **kwargs) -> torch.Tensor:
+        single = isinstance(sentences, str)
+        tokens = self.tokenizer([sentences] if single else sentences,
+                                return_tensors='pt', padding=True,
+                                truncation=True, max_length=self.max_seq_length)
+        token_embeddings = self.backend(**tokens)['last_hidden_state']
+        mask = tokens['attention_mask'].unsqueeze(-1).to(token_embeddings.dtype)
+        embeddings = (token_embeddings * mask).sum(dim=1) / \
+            torch.clamp(mask.sum(dim=1), min=1e-9)
+        return embeddings[0] if single else embeddings
+
+
+def build_inference_backend(backend: str, model, tokenizer,
+                            onnx_path: Optional[str] = None,
+                            inplace: bool = True) -> Tuple:
+    """
+    Returns the scorer model callable and the sentence encoder for semantic
+    search (None means keep the SentenceTransformer, which shares `model`).
+    """
+    if backend == 'eager':
+        return model, None
+    if backend == 'quantized':
+        return DynamicQuantizedBackend(model, inplace=inplace), None
+    if backend == 'onnx':
+        onnx_backend = OnnxBackend(model, tokenizer,
+                                   onnx_path or 'rubert-base-cased-sentence.onnx',
+                                   intra_op_threads=torch.get_num_threads())
+        return onnx_backend, BackendSentenceEncoder(onnx_backend, tokenizer)
+    raise ValueError(f"Unknown inference backend {backend}, "
+                     f"expected one of {INFERENCE_BACKENDS}")
@@ -1,20 +1,66 @@
 import argparse
-from typing import Optional, Any
+import os
+import threading
+import traceback
+from functools import partial
+from typing import Callable, Optional
 
-from transformers import AutoTokenizer, AutoModel
-from sentence_transformers import SentenceTransformer
-from pipeline.index import InvertedIndex,Database
 from pipeline.scorer import SentenceBertScorer
 from pipeline.tf_idf_searcher import TfidfSearch
+from pipeline.scoring_engine import ScoringEngine
 from pipeline.semantic_search import SemanticSearch
-import dill as pickle
-import stanza
+from pipeline.index_storage import open_index, get_index_meta, get_index_version, \
+    get_version_paths
+from pipeline.ann import load_or_build_ivf, load_or_build_int8
+from pipeline.batching import MicroBatcher
+from pipeline.models import registry
+from pipeline.inference_backends import build_inference_backend
+from pipeline.search_utils import morph_lemmatizer
+from pipeline.segmented_index import SegmentedIndex
+from pipeline.delta_log import DeltaLog, DeltaLogGap, try_lock
 import itertools
 
-searcher = None
-scorer = None
-indexdb = None
-semantic_searcher = None
+# loaded once, shared by the views of every index served
+models = dict()
+index_settings = dict()
+view = None
+merge_thread = None
+merge_lock = threading.Lock()
+reload_lock = threading.Lock()
+reload_status = {'reloading': False, 'error': None, 'failed_version': None}
+watch_stop = threading.Event()
+
+
+class IndexView:
+    """
+    Everything a request reads from one index: the index, its searchers
+    and the scorer over its sentence store. A request takes pipeline.view
+    once; reloads and merges build a new view and swap the reference, so a
+    request never mixes two indexes.
+    source_version: version of the index files the view was opened from.
+    delta_log: log of the updates of the index lineage, replayed on index.
+    """
+    def __init__(self, index: SegmentedIndex, searcher: TfidfSearch,
+                 semantic_searcher: SemanticSearch, scorer: SentenceBertScorer,
+                 source_version: Optional[str] = None,
+                 delta_log: Optional[DeltaLog] = None):
+        self.index = index
+        self.searcher = searcher
+        self.semantic_searcher = semantic_searcher
+        self.scorer = scorer
+        self.source_version = source_version
+        self.delta_log = delta_log
+
+    def __repr__(self):
+        return f'IndexView(version={self.version}, documents={len(self.db)})'
+
+    @property
+    def db(self):
+        return self.index.db
+
+    @property
+    def version(self) -> str:
+        return self.index.version
 
 def stanza_nlp_ru(text, nlp):
     doc = nlp(text)
@@ -35,16 +81,23 @@ def estimate_news_paper(text: str,
                         scoring_type='bm_25',
                         k_top_precandidates=100,
                         semantic_average: bool = False,
-                        highlight_k_top: int = 3):
-    pre_candidates = semantic_searcher.search(text, k_top_precandidates)
+                        highlight_k_top: int = 3,
+                        index_view: Optional[IndexView] = None):
+    """
+    index_view: view the request reads, the served one by default.
+    """
+    index_view = index_view or view
+    # stanza and the entity lookups run once, the stages share the result
+    analysis = index_view.searcher.analyze(text)
+    pre_candidates = index_view.semantic_searcher.search(analysis.text, k_top_precandidates)
 
-    white_list_candidates = searcher.search(text, scoring_type=scoring_type,
-                                            k_top=k_top_candidates,
-                                            pre_candidates=pre_candidates)
+    white_list_candidates = index_view.searcher.search(analysis, scoring_type=scoring_type,
+                                                       k_top=k_top_candidates,
+                                                       pre_candidates=pre_candidates)
     if not white_list_candidates:
         return 0, [], []
     avg_min_score_per_document = \
-        scorer.get_avg_min_score_per_document(white_list_candidates)
+        index_view.scorer.get_avg_min_score_per_document(white_list_candidates)
 
     white_list_candidates_similarity = {candidate['doc_id']: pre_candidates[candidate['doc_id']]
                                         for candidate in white_list_candidates}
@@ -79,9 +132,9 @@ def estimate_news_paper(text: str,
 def highlight(doc_id_top: list,
               doc_sentences: dict,
               #indexdb: Database
-              ):
+              index_view: Optional[IndexView] = None):
 
-    global indexdb
+    indexdb = (index_view or view).db
     info = dict()
 
     ids = [data[0] for data in doc_id_top]
@@ -103,32 +156,393 @@ def highlight(doc_id_top: list,
 
 
 
-def setup(index_path: str):
-    with open(index_path, "rb") as f:
-        index = pickle.load(f)
+def get_ann_path(index_path: str) -> str:
+    if os.path.isdir(index_path):
+        return os.path.join(index_path, 'ann')
+    return f'{index_path}.ann'
+
+
+def get_merge_path(index_path: str) -> str:
+    if os.path.isdir(index_path):
+        return index_path
+    return f'{index_path}.mmap'
+
+
+def get_served_path(index_path: str) -> str:
+    """
+    The index merged from the one at index_path if there is one: a pickle
+    is merged into a directory of its own, a directory into new versions
+    of itself.
+    """
+    merge_path = get_merge_path(index_path)
+    if merge_path != index_path and os.path.isdir(merge_path) and \
+            get_index_meta(merge_path).get('delta_lineage') == get_index_version(index_path):
+        return merge_path
+    return index_path
+
+
+def get_delta_log_root(index_path: str) -> str:
+    return f'{get_merge_path(index_path)}.delta'
+
+
+def attach_ann_search(semantic_searcher: SemanticSearch, ann_path: str,
+                      ann_backend: str, ann_n_probe: int,
+                      ann_rerank_factor: int,
+                      index_version: Optional[str] = None) -> None:
+    if ann_backend == 'ivf':
+        semantic_searcher.ann_search = load_or_build_ivf(
+            os.path.join(ann_path, 'ivf'),
+            semantic_searcher.corpus_embeddings, n_probe=ann_n_probe,
+            index_version=index_version)
+    elif ann_backend == 'int8':
+        semantic_searcher.ann_search = load_or_build_int8(
+            os.path.join(ann_path, 'int8'),
+            semantic_searcher.corpus_embeddings,
+            rerank_factor=ann_rerank_factor, index_version=index_version)
+
+
+def setup(index_path: str, ann_backend: str = 'exact',
+          ann_n_probe: int = 8, ann_rerank_factor: int = 4,
+          micro_batching: bool = False, micro_batch_wait_ms: float = 5.0,
+          inference_backend: str = 'eager', onnx_path: Optional[str] = None,
+          segment_merge_size: int = 10000):
+    """
+    ann_backend: 'exact' brute-force semantic search, 'ivf' approximate
+    search or 'int8' quantized search, the approximate structures are
+    persisted next to the index.
+    micro_batching: coalesce the rubert encoder calls of concurrent
+    requests into shared batches.
+    inference_backend: 'eager' float32, 'quantized' int8 dynamic quantized
+    Linear layers or 'onnx' onnxruntime graph cached at onnx_path.
+    segment_merge_size: documents added or removed since the last merge
+    that start a background merge of the delta segment into the base.
+    """
+    index_settings.update(ann_backend=ann_backend,
+                          ann_n_probe=ann_n_probe,
+                          ann_rerank_factor=ann_rerank_factor,
+                          segment_merge_size=segment_merge_size)
+    nlp = registry.get_stanza_pipeline('ru', 'tokenize,ner')
+    models['nlp'] = nlp
+    models['ner_algorithm'] = lambda text: get_raw_entities_from_text(text, nlp)
+    # one rubert instance serves both semantic search and the scorer
+    embedder = registry.get_sentence_transformer()
+    sentence_bert_model, sentence_bert_tokenizer = registry.get_encoder()
+    sentence_bert_model, sentence_encoder = build_inference_backend(
+        inference_backend, sentence_bert_model, sentence_bert_tokenizer, onnx_path)
+    models['sentence_transformer_model'] = sentence_encoder or embedder
+    models['sentence_bert_model'] = sentence_bert_model
+    models['sentence_bert_tokenizer'] = sentence_bert_tokenizer
+    models['scorer_encoder'] = None
+    models['semantic_encoder'] = None
+    if micro_batching:
+        models['scorer_encoder'] = MicroBatcher(
+            SentenceBertScorer(sentence_bert_model,
+                               sentence_bert_tokenizer).encode_sentences,
+            max_wait_ms=micro_batch_wait_ms, name='scorer-batcher')
+        models['semantic_encoder'] = MicroBatcher(
+            lambda texts: models['sentence_transformer_model'].encode(
+                texts, convert_to_tensor=True),
+            max_batch_size=16, max_wait_ms=micro_batch_wait_ms,
+            name='semantic-batcher')
+
+    reload_index(index_path)
+    return view.db, view.searcher, view.scorer, view.semantic_searcher
+
+
+def build_view(index: SegmentedIndex, ann_path: str,
+               source_version: Optional[str] = None,
+               delta_log: Optional[DeltaLog] = None) -> IndexView:
+    """
+    Searchers and scorer of an index on top of the loaded models.
+    """
+    # the corpus matrix of the semantic search is the one of this version
+    version = index.version
+    searcher = TfidfSearch(index, ner_algorithm=models['ner_algorithm'],
+                           scoring_engine=ScoringEngine(index), nlp=models['nlp'])
+    semantic_searcher = SemanticSearch(models['sentence_transformer_model'], index,
+                                       encoder=models['semantic_encoder'])
+    attach_ann_search(semantic_searcher, ann_path,
+                      index_settings['ann_backend'],
+                      index_settings['ann_n_probe'],
+                      index_settings['ann_rerank_factor'], version)
+    scorer = SentenceBertScorer(models['sentence_bert_model'],
+                                models['sentence_bert_tokenizer'],
+                                sentence_store=getattr(index, 'sentence_store', None),
+                                sentence_encoder=models['scorer_encoder'])
+    return IndexView(index, searcher, semantic_searcher, scorer, source_version, delta_log)
+
+
+def check_view(view: IndexView) -> None:
+    """
+    Smoke test before a view serves requests: a stored document is found
+    by its entities and the semantic search runs over the corpus matrix.
+    """
+    if not len(view.db):
+        raise ValueError(f'{view} has no documents')
+    doc_id = next(iter(view.db.keys()))
+    document = view.db.get(doc_id)
+    postings = view.index.lookup_query(set(document['entity_frequency']))
+    if document['entity_frequency'] and \
+            not any(doc_id in posting_list.doc_ids for posting_list in postings.values()):
+        raise ValueError(f'{view}: document {doc_id} is missing from the postings')
+    if not view.semantic_searcher.search(document['text'], 1):
+        raise ValueError(f'{view}: semantic search returned nothing')
+
+
+def reload_index(index_path: Optional[str] = None) -> str:
+    """
+    Opens the index at index_path (default: the served one), or the index
+    merged from it, replays the updates logged after it, builds and checks
+    its view and swaps it in, returns the new version. Requests in flight
+    finish on the previous view.
+    """
+    global view
+
+    index_path = index_path or index_settings['index_path']
+    with reload_lock:
+        served_path = get_served_path(index_path)
+        # new documents go to the in-memory delta segment of the index
+        index = SegmentedIndex(open_index(served_path))
+        morph_lemmatizer.warm_up(getattr(index, 'lemma_warm_set', dict()))
+        delta_log = DeltaLog(os.path.join(get_delta_log_root(index_path), index.lineage),
+                             index.seq)
+        # built before the replay: the ann structures are keyed on the base
+        new_view = build_view(index, get_ann_path(served_path), index.base.version,
+                              delta_log)
+        delta_log.catch_up(partial(apply_update, new_view))
+        check_view(new_view)
+        index_settings.update(index_path=index_path,
+                              merge_path=get_merge_path(index_path))
+        view = new_view
+        reload_status.update(error=None, failed_version=None)
+    return new_view.version
+
+
+def reload_in_background() -> bool:
+    """
+    Starts reload_index of the served index path in a thread, False when a
+    reload is already running.
+    """
+    with merge_lock:
+        if reload_status['reloading']:
+            return False
+        reload_status['reloading'] = True
+
+    def reload():
+        try:
+            # a merge may replace the served index while it loads
+            while True:
+                reload_index()
+                if get_served_version_or_none(index_settings['index_path']) in \
+                        (None, view.source_version):
+                    break
+        except Exception as e:
+            reload_status.update(error=f'{type(e).__name__}: {e}',
+                                 failed_version=get_served_version_or_none(
+                                     index_settings['index_path']))
+            traceback.print_exc()
+        finally:
+            reload_status['reloading'] = False
+
+    threading.Thread(target=reload, name='index-reload', daemon=True).start()
+    return True
+
+
+def get_served_version_or_none(index_path: str) -> Optional[str]:
+    try:
+        return get_index_version(get_served_path(index_path))
+    except (OSError, ValueError):
+        # the index is being replaced or was never fully written
+        return None
+
+
+def apply_update(index_view: IndexView, entry: dict) -> None:
+    """
+    Applies an entry of the delta log to the index of a view.
+    """
+    index = index_view.index
+    if entry['op'] == 'add':
+        doc_ids = index.add_documents([dict(document) for document in entry['documents']],
+                                      seq=entry['seq'])
+        if doc_ids != entry['doc_ids']:
+            raise ValueError(f"{index} added the documents of update {entry['seq']} "
+                             f"as {doc_ids}, logged as {entry['doc_ids']}")
+    elif entry['op'] == 'remove':
+        index.remove_document(entry['doc_id'], seq=entry['seq'])
+    else:
+        # merged: the updates so far are in a new version of the index
+        index.mark(entry['seq'])
+        if index_view is view and entry['version'] != index_view.source_version:
+            reload_in_background()
+
+
+def sync_updates() -> None:
+    """
+    Replays the updates the other processes logged on the served view.
+    """
+    current_view = view
+    if not current_view.delta_log.changed():
+        return
+    try:
+        current_view.delta_log.catch_up(partial(apply_update, current_view))
+    except ValueError:
+        # updates pruned after a merge this process missed
+        traceback.print_exc()
+        reload_in_background()
+
+
+def watch_index(interval: float) -> threading.Thread:
+    """
+    Replays the logged updates and reloads the index once a new build or a
+    merge replaces the files served, checked every interval seconds. A
+    version that failed to load is not retried until it changes again.
+    """
+    def poll():
+        while not watch_stop.wait(interval):
+            source_version = get_served_version_or_none(index_settings['index_path'])
+            if source_version is None or \
+                    source_version in (view.source_version,
+                                       reload_status['failed_version']):
+                sync_updates()
+                continue
+            reload_in_background()
+
+    thread = threading.Thread(target=poll, name='index-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+def index_status() -> dict:
+    return {'version': view.version,
+            'documents': len(view.db),
+            'delta_size': view.index.delta_size,
+            'index_path': index_settings['index_path'],
+            'reloading': reload_status['reloading'],
+            'merging': merge_thread is not None and merge_thread.is_alive(),
+            'error': reload_status['error']}
+
+
+def prepare_document(document: dict, view: IndexView) -> dict:
+    """
+    Fills the entities and the embedding of a parsed article that has none.
+    """
+    if 'raw_entity' not in document:
+        document['raw_entity'] = list(set(view.searcher.ner_algorithm(document['text'])))
+    if 'entity' not in document:
+        document['entity'] = list({view.searcher.lemmatizer(raw_entity)
+                                   for raw_entity in document['raw_entity']})
+    if 'rubert-base-cased-sentence_embedding' not in document:
+        document['rubert-base-cased-sentence_embedding'] = \
+            view.semantic_searcher.sentence_transformer_model.encode(
+                document['text'], convert_to_tensor=True).tolist()
+    return document
+
+
+def log_update(build_entry: Callable[[SegmentedIndex], Optional[dict]]) -> Optional[dict]:
+    """
+    Appends the update build_entry makes from the caught up index to the
+    delta log and applies it, None when build_entry returns None. Retried
+    on the new view when a reload swapped in an index of another build,
+    DeltaLogGap when this process missed a merge.
+    """
+    while True:
+        current_view = view
+        stale = []
+
+        def build() -> Optional[dict]:
+            if view.index.lineage != current_view.index.lineage:
+                stale.append(view)
+                return None
+            return build_entry(current_view.index)
+
+        try:
+            entry = current_view.delta_log.append(build, partial(apply_update, current_view))
+        except DeltaLogGap:
+            # the caller may retry once the merged index is loaded
+            reload_in_background()
+            raise
+        if not stale:
+            return entry
+
+
+def add_documents(documents: list) -> list:
+    """
+    Indexes parsed articles right away, returns their doc ids. The update
+    is logged before it is applied, every process replays it under the
+    same doc ids.
+    """
+    current_view = view
+    documents = [prepare_document(document, current_view) for document in documents]
+    entry = log_update(lambda index: {
+        'op': 'add', 'documents': documents,
+        'doc_ids': list(range(index.n_documents, index.n_documents + len(documents)))})
+    merge_if_needed()
+    return entry['doc_ids']
+
+
+def remove_document(doc_id: int) -> bool:
+    """
+    False when there is no document doc_id.
+    """
+    entry = log_update(lambda index: {'op': 'remove', 'doc_id': doc_id}
+                       if index.db.get(doc_id) is not None else None)
+    merge_if_needed()
+    return entry is not None
+
+
+def merge_if_needed() -> None:
+    """
+    Starts a background merge of the delta segment once it holds
+    segment_merge_size updates.
+    """
+    global merge_thread
 
-    global searcher
-    global scorer
-    global indexdb
-    global semantic_searcher
+    with merge_lock:
+        merging_view = view
+        if merging_view.index.delta_size < index_settings['segment_merge_size'] or \
+                reload_status['reloading'] or \
+                (merge_thread is not None and merge_thread.is_alive()):
+            return
+        merge_thread = threading.Thread(target=merge_index, args=(merging_view,),
+                                        name='segment-merge', daemon=True)
+        merge_thread.start()
 
-    indexdb = index.db
-    stanza.download('ru')
-    nlp = stanza.Pipeline(lang='ru', processors='tokenize,ner')
-    ner_algorithm = lambda text: get_raw_entities_from_text(text, nlp)
-    searcher = TfidfSearch(index, ner_algorithm=ner_algorithm)
-    sentence_bert_tokenizer = AutoTokenizer.from_pretrained("DeepPavlov/rubert-base-cased-sentence")
-    sentence_bert_model = AutoModel.from_pretrained("DeepPavlov/rubert-base-cased-sentence")
-    embedder = SentenceTransformer('DeepPavlov/rubert-base-cased-sentence')
-    semantic_searcher = SemanticSearch(embedder, index)
-    scorer = SentenceBertScorer(sentence_bert_model,
-                                sentence_bert_tokenizer)
 
-    return index.db, searcher, scorer, semantic_searcher
+def merge_index(merging_view: IndexView) -> None:
+    """
+    Writes the index of a view as a new version at the merge path and logs
+    it: every process, this one included, reloads it when it replays the
+    notice. One process of the host merges at a time.
+    """
+    index_path = index_settings['index_path']
+    merge_path = get_merge_path(index_path)
+    delta_log = merging_view.delta_log
+    apply = partial(apply_update, merging_view)
+    try:
+        with try_lock(os.path.join(get_delta_log_root(index_path), 'merge.lock')) as locked:
+            if not locked or \
+                    get_served_version_or_none(index_path) != merging_view.source_version:
+                # merging in another process or merged already
+                return
+            version = merging_view.index.write(merge_path)
+            delta_log.append(lambda: {'op': 'merged', 'version': version}, apply)
+            delta_log.rotate(apply)
+            # the kept versions of the lineage replay the log from their seq
+            metas = []
+            for version_path in get_version_paths(merge_path):
+                try:
+                    metas.append(get_index_meta(version_path))
+                except OSError:
+                    continue
+            delta_log.prune(min((meta.get('delta_seq', 0) for meta in metas
+                                 if meta.get('delta_lineage', meta['version']) ==
+                                 merging_view.index.lineage), default=0))
+    except Exception:
+        traceback.print_exc()
 
 
 def main(index_path: str):
-    db, searcher, scorer = setup(index_path)
+    setup(index_path)
     text = """В мире Москва занимает третье место, уступая лишь Нью-Йорку и Сан-Франциско.
     Москва признана первой среди европейских городов в рейтинге инноваций, помогающих в формировании устойчивости коронавирусу. Она опередила Лондон и Барселону.
     Среди мировых мегаполисов российская столица занимает третью строчку — поысле Сан-Франциско и Нью-Йорка. Пятерку замыкают Бостон и Лондон. Рейтинг составило международное исследовательское агентство StartupBlink.
@@ -137,8 +551,10 @@ def main(index_path: str):
     Еще одно инновационное решение — облачная платформа, которая объединяет пациентов, врачей, медицинские организации, страховые компании, фармакологические производства и сайты.
     Способствовали высоким результатам и технологии, которые помогают адаптировать жизнь горожан во время пандемии. Это проекты в сфере умного туризма, электронной коммерции и логистики, а также дистанционной работы и онлайн-образования.
     Эксперты агентства StartupBlink оценивали принятые в Москве меры с точки зрения эпидемиологических показателей и влияния на экономику."""
-    result = estimate_news_paper(text, searcher, scorer, k_top_candidates=10, scoring_type='intersection')
-    print(result[1])
+    score, doc_id_top, doc_sentences = estimate_news_paper(text, k_top_candidates=10,
+                                                          scoring_type='intersection')
+    print(score)
+    print(highlight(doc_id_top, doc_sentences))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pipeline")
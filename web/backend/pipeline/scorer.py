@@ -1,3 +1,4 @@
+import itertools
 import numpy as np
 
 import torch
@@ -21,12 +22,91 @@ class SentenceBertScorer:
     def __init__(self, sentence_bert_model,
                  sentence_tokenizer,
                  metric: str = 'cosine',
-                 p: int = 2):
+                 p: int = 2,
+                 sentence_store=None,
+                 sentence_encoder=None):
+        """
+        sentence_encoder: List[str] -> embeddings callable used by the
+        batched mode instead of encode_sentences, e.g. a batching.MicroBatcher
+        shared by concurrent requests.
+        """
         self.sentence_bert_model = sentence_bert_model
         self.sentence_tokenizer = sentence_tokenizer
+        self.sentence_store = sentence_store
+        self.sentence_encoder = sentence_encoder
         self.metric = metric
         self.p = p
 
+    def encode_sentences(self, sentences: List[str],
+                         batch_size: int = 32) -> torch.Tensor:
+        """
+        Encodes sentences in length-bucketed batches: sentences are sorted by
+        length, so each padded batch holds sentences of similar size.
+        Rows of the result follow the order of the input sentences.
+        """
+        if not sentences:
+            return torch.empty(0)
+        order = sorted(range(len(sentences)),
+                       key=lambda idx: len(sentences[idx]))
+        embeddings = [None] * len(sentences)
+        for batch_start in range(0, len(order), batch_size):
+            batch_order = order[batch_start:batch_start + batch_size]
+            batch_tokens = self.sentence_tokenizer(
+                [sentences[idx] for idx in batch_order],
+                return_tensors="pt", padding=True)
+            with torch.no_grad():
+                batch_emb = \
+                    self.sentence_bert_model(**batch_tokens)['pooler_output']
+            for idx, sentence_emb in zip(batch_order, batch_emb):
+                embeddings[idx] = sentence_emb
+        return torch.stack(embeddings)
+
+    def get_embedding_table(self, candidates) -> tuple:
+        """
+        Encodes every unique query and source sentence of the candidates
+        exactly once. Source sentences precomputed in the sentence store are
+        looked up instead of encoded.
+        Returns sentence -> row mapping and embedding matrix.
+        """
+        stored_sentences = dict()
+        sentences = set()
+        for candidate in candidates:
+            for entity_info in candidate['entity'].values():
+                sentences.update(entity_info['query_sentences'])
+                src_sentence_ids = entity_info.get('src_sentence_ids')
+                if (self.sentence_store is not None and
+                        src_sentence_ids is not None and
+                        self.sentence_store.is_embedded(src_sentence_ids)):
+                    stored_sentences.update(zip(entity_info['src_sentences'],
+                                                src_sentence_ids))
+                else:
+                    sentences.update(entity_info['src_sentences'])
+        stored_sentences = sorted(
+            (sentence, sentence_id)
+            for sentence, sentence_id in stored_sentences.items()
+            if sentence not in sentences)
+        sentences = sorted(sentences)
+        sentence_rows = {sentence: row for row, sentence in
+                         enumerate(itertools.chain(
+                             sentences,
+                             (sentence for sentence, _ in stored_sentences)))}
+        embeddings = self.sentence_encoder(sentences) \
+            if self.sentence_encoder is not None and sentences \
+            else self.encode_sentences(sentences)
+        if stored_sentences:
+            stored_emb = self.sentence_store.get(
+                [sentence_id for _, sentence_id in stored_sentences])
+            embeddings = torch.cat([embeddings.reshape(-1, stored_emb.shape[1]),
+                                    stored_emb])
+        return sentence_rows, embeddings
+
+    def score_embeddings(self, query_emb: torch.Tensor,
+                         src_emb: torch.Tensor):
+        if self.metric == 'cosine':
+            return get_cosine_cdist(query_emb, src_emb)
+        elif self.metric == 'minkowski':
+            return torch.cdist(query_emb, src_emb, p=2.0)
+
     def get_score_matrix(self, query_sentences: List[str],
                          src_sentences: List[str]):
         query_tokens = self.sentence_tokenizer(query_sentences,
@@ -38,11 +118,17 @@ class SentenceBertScorer:
                 self.sentence_bert_model(**query_tokens)['pooler_output']
             src_emb = \
                 self.sentence_bert_model(**src_tokens)['pooler_output']
-
-        if self.metric == 'cosine':
-            return get_cosine_cdist(query_emb, src_emb)
-        elif self.metric == 'minkowski':
-            return torch.cdist(query_emb, src_emb, p=2.0)
+        return self.score_embeddings(query_emb, src_emb)
+
+    def get_score_matrix_from_table(self, query_sentences: List[str],
+                                    src_sentences: List[str],
+                                    embedding_table: tuple):
+        sentence_rows, embeddings = embedding_table
+        query_emb = embeddings[[sentence_rows[sentence]
+                                for sentence in query_sentences]]
+        src_emb = embeddings[[sentence_rows[sentence]
+                              for sentence in src_sentences]]
+        return self.score_embeddings(query_emb, src_emb)
 
     def get_k_nearest_neighbours_per_entity(self, query_sentences: List[str],
                                             src_sentences: List[str],
@@ -64,10 +150,16 @@ class SentenceBertScorer:
         return dict(query_sentences_pairs)
 
     def get_score_pairs_per_entity(self, query_sentences: List[str],
-                                   src_sentences: List[str]) -> dict:
-        score_matrix = 1 - self.get_score_matrix(query_sentences,
+                                   src_sentences: List[str],
+                                   embedding_table: Optional[tuple] = None) -> dict:
+        if embedding_table is None:
+            score_matrix = self.get_score_matrix(query_sentences,
                                                  src_sentences)
-        return score_matrix.max().item()
+        else:
+            score_matrix = self.get_score_matrix_from_table(query_sentences,
+                                                            src_sentences,
+                                                            embedding_table)
+        return (1 - score_matrix).max().item()
 
 
     def get_score_pairs(self, candidates):
@@ -80,7 +172,12 @@ class SentenceBertScorer:
                     self.get_score_per_entity(query_sentences, src_sentences)
         return query_sentences_pairs
 
-    def get_avg_min_score_per_document(self, candidates):
+    def get_avg_min_score_per_document(self, candidates, batched: bool = True):
+        """
+        batched: encode all sentences of all candidates in one pass instead
+        of running the model per (candidate, entity) pair.
+        """
+        embedding_table = self.get_embedding_table(candidates) if batched else None
         candidate_scores_dict = {}
         for candidate in candidates:
             candidate_score = 0
@@ -89,7 +186,8 @@ class SentenceBertScorer:
                 src_sentences = candidate['entity'][entity]['src_sentences']
                 query_sentences = candidate['entity'][entity]['query_sentences']
                 min_pair_score = self.get_score_pairs_per_entity(query_sentences,
-                                                                 src_sentences)
+                                                                 src_sentences,
+                                                                 embedding_table)
                 entity_score = candidate['entity'][entity]['score']
                 candidate_score += min_pair_score * entity_score
                 accumulate_entity_score += entity_score
@@ -112,4 +210,4 @@ class SentenceBertScorer:
         query_emb = self.sentence_bert_model(**query_tokens)['pooler_output']
         src_emb = self.sentence_bert_model(**src_tokens)['pooler_output']
         cos = CosineSimilarity(dim=1)
-        return cos(query_emb, src_emb)
\ No newline at end of file
+        return cos(query_emb, src_emb)
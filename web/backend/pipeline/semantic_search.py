@@ -1,21 +1,70 @@
 from pipeline.index import InvertedIndex
-from sentence_transformers import util
-import torch
+from pipeline.ann import ExactSearch
+
 
 class SemanticSearch:
     def __init__(self, sentence_transformer_model,
-                 index: InvertedIndex):
+                 index: InvertedIndex,
+                 ann_search=None,
+                 encoder=None):
+        """
+        ann_search: approximate backend (ann.IVFSearch, ann.Int8Search) over the corpus
+        embeddings, exact brute-force search is used when it is None.
+        encoder: List[str] -> embeddings callable used instead of
+        sentence_transformer_model.encode, e.g. a batching.MicroBatcher.
+        """
         self.sentence_transformer_model = sentence_transformer_model
-        doc_ids, corpus_embeddings = InvertedIndex.get_corpus_embeddings(index)
+        self.encoder = encoder
+        self.index = index
+        doc_ids, corpus_embeddings = index.get_corpus_embeddings()
         self.doc_ids = doc_ids
-        self.corpus_embeddings = corpus_embeddings
+        # documents added to a segmented index later are searched exactly
+        # over its delta segment
+        self.n_documents = max(doc_ids, default=-1) + 1
+        self.corpus_embeddings = corpus_embeddings.numpy()
+        self._exact_search = None
+        self.ann_search = ann_search
+
+    @property
+    def exact_search(self) -> ExactSearch:
+        """
+        Built on first use, so approximate backends don't page in the whole
+        float corpus matrix.
+        """
+        if self._exact_search is None:
+            self._exact_search = ExactSearch(self.corpus_embeddings)
+        return self._exact_search
 
-    def search(self, paper_text, k_top: int=10):
-        paper_embeddings =\
-            self.sentence_transformer_model.encode(paper_text,
-                                                   convert_to_tensor=True)
-        best_candidates = util.semantic_search(paper_embeddings,
-                                               self.corpus_embeddings,
-                                               top_k=k_top)[0]
-        return {self.doc_ids[candidate['corpus_id']]: candidate['score']
-                for candidate in best_candidates}
+    def search(self, paper_text, k_top: int=10, exact: bool = False):
+        if self.encoder is not None:
+            paper_embeddings = self.encoder([paper_text])[0]
+        else:
+            paper_embeddings =\
+                self.sentence_transformer_model.encode(paper_text,
+                                                       convert_to_tensor=True)
+        backend = self.exact_search if exact or self.ann_search is None \
+            else self.ann_search
+        query_embedding = paper_embeddings.cpu().numpy()
+        deleted = getattr(self.index, 'deleted', set())
+        base_deleted = getattr(self.index, 'base_deleted', frozenset())
+        n_rows = len(self.doc_ids)
+        # over-fetch by at most k_top for removed rows, more only when the
+        # top rows turn out to be mostly removed ones
+        fetch = min(k_top + min(k_top, len(deleted) + len(base_deleted)), n_rows)
+        while True:
+            rows, scores = backend.search(query_embedding, fetch)
+            results = [(self.doc_ids[row], score)
+                       for row, score in zip(rows.tolist(), scores.tolist())
+                       if self.doc_ids[row] not in deleted and
+                       self.doc_ids[row] not in base_deleted]
+            if len(results) >= k_top or fetch >= n_rows or len(rows) < fetch:
+                break
+            fetch = min(fetch * 4, n_rows)
+        if hasattr(self.index, 'get_delta_embeddings'):
+            doc_ids, delta_embeddings = self.index.get_delta_embeddings(self.n_documents)
+            if doc_ids:
+                rows, scores = ExactSearch(delta_embeddings).search(query_embedding, k_top)
+                results.extend((doc_ids[row], score)
+                               for row, score in zip(rows.tolist(), scores.tolist()))
+                results.sort(key=lambda pair: pair[1], reverse=True)
+        return dict(results[:k_top])
@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+from tqdm import tqdm
+from typing import Callable, List, Optional
+
+
+class SentenceEmbeddingStore:
+    """
+    Embeddings of the indexed entity-context sentences, keyed by sentence id.
+    Sentences are registered at index time and encoded once by `embed`.
+    """
+    def __init__(self, dtype: str = 'float32'):
+        self.sentences = []
+        self.sentence_ids = dict()
+        self.embeddings: Optional[np.ndarray] = None
+        self.dtype = dtype
+
+    def __repr__(self):
+        """
+        String representation of the SentenceEmbeddingStore object
+        """
+        return f'SentenceEmbeddingStore(sentences={len(self)}, dtype={self.dtype})'
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def add(self, sentence: str) -> int:
+        """
+        Registers a sentence and returns its id.
+        """
+        sentence_id = self.sentence_ids.get(sentence)
+        if sentence_id is None:
+            sentence_id = len(self.sentences)
+            self.sentence_ids[sentence] = sentence_id
+            self.sentences.append(sentence)
+        return sentence_id
+
+    def is_embedded(self, sentence_ids: List[int]) -> bool:
+        if self.embeddings is None:
+            return False
+        return all(sentence_id < len(self.embeddings)
+                   for sentence_id in sentence_ids)
+
+    def embed(self, encode_fn: Callable[[List[str]], torch.Tensor],
+              batch_size: int = 256) -> None:
+        """
+        Encodes the sentences which have no embedding yet.
+        """
+        start = 0 if self.embeddings is None else len(self.embeddings)
+        chunks = [] if self.embeddings is None else [self.embeddings]
+        for batch_start in tqdm(range(start, len(self.sentences), batch_size)):
+            batch_emb = encode_fn(
+                self.sentences[batch_start:batch_start + batch_size])
+            chunks.append(batch_emb.cpu().numpy().astype(self.dtype))
+        if chunks:
+            self.embeddings = np.concatenate(chunks)
+
+    def get(self, sentence_ids: List[int]) -> torch.Tensor:
+        return torch.from_numpy(
+            np.asarray(self.embeddings[sentence_ids], dtype=np.float32))
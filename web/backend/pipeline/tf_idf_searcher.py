@@ -1,9 +1,10 @@
-from collections import Counter, defaultdict
-from typing import List, Optional
-import numpy as np
+from collections import Counter
+from typing import List, Optional, Union
 
+from pipeline.analysis import DocumentAnalysis
 from pipeline.index import InvertedIndex
-from pipeline.search_utils import lemmatize_text, find_all_entities, extract_entity_sentence
+from pipeline.scoring_engine import ScoringEngine
+from pipeline.search_utils import lemmatize_text
 
 
 class TfidfSearch:
@@ -13,14 +14,28 @@ class TfidfSearch:
 
     def __init__(self, index: InvertedIndex,
                  ner_algorithm,
-                 lemmatizer=lemmatize_text):
+                 lemmatizer=lemmatize_text,
+                 scoring_engine: Optional[ScoringEngine] = None,
+                 nlp=None):
+        """
+        nlp: stanza pipeline, when set the paper is analyzed through it
+        once (DocumentAnalysis) instead of calling ner_algorithm.
+        """
         self.index = index
         self.ner_algorithm = ner_algorithm
         self.lemmatizer = lemmatizer
+        self.scoring_engine = scoring_engine
+        self.nlp = nlp
 
-    """ document_frequency id is required """
+    def analyze(self, paper_text: str) -> DocumentAnalysis:
+        if self.nlp is not None:
+            return DocumentAnalysis(paper_text, self.lemmatizer, nlp=self.nlp)
+        return DocumentAnalysis(paper_text, self.lemmatizer,
+                                raw_entities=self.ner_algorithm(paper_text))
+
+    """ idf table is required """
     def is_ready(self):
-        return hasattr(self.index, 'document_frequency')
+        return bool(getattr(self.index, 'idf', None))
 
     def calculate_bm25_score(self, document_entity_tf, entity_idf,
                              doc_len, avg_len, b=0.75, k=1.5):
@@ -40,8 +55,7 @@ class TfidfSearch:
                 continue
             document_entity_tf = document_entity_frequency[entity] / \
                                  document_total_frequency
-            entity_idf = np.log((len(self.index.db) - self.index.document_frequency[entity]) /
-                                self.index.document_frequency[entity])
+            entity_idf = self.index.idf[entity]
             bm_25 = self.calculate_bm25_score(document_entity_tf,
                                               entity_idf,
                                               doc_len,
@@ -58,49 +72,61 @@ class TfidfSearch:
         for entity in entity_intersection:
             if entity not in self.index.index:
                 continue
-            entity_idf = np.log((len(self.index.db) - self.index.document_frequency[entity]) /
-                                  self.index.document_frequency[entity])
+            entity_idf = self.index.idf[entity]
             score_per_entity = entity_idf
             entity_score[entity] = score_per_entity
             score += entity_idf
         return score, entity_score
 
-    def get_document_ranking_by_paper(self, paper_text: str,
-                                      scoring_type: str='intersection',
-                                      pre_candidates: Optional[dict]=None) -> list:
-        raw_news_entities = self.ner_algorithm(paper_text)
-        paper_entity_context = defaultdict(set)
-        news_entity_frequency = defaultdict(int)
-        for raw_entity in raw_news_entities:
-            normalized_entity = self.lemmatizer(raw_entity)
-            for entity_idx in find_all_entities(paper_text, raw_entity):
-                entity_context = extract_entity_sentence(paper_text,
-                                                          entity_idx)
-                paper_entity_context[normalized_entity].add(entity_context)
-                news_entity_frequency[normalized_entity] += 1
-        unique_news_entities = set(paper_entity_context.keys())
-        news_entity_frequency = Counter(news_entity_frequency)
-        index_response = self.index.lookup_query(unique_news_entities)
-        index_candidates = {appearance.docId
-                            for entity_response in index_response.values()
-                            for appearance in entity_response
-                            if (pre_candidates is None or
-                                appearance.docId in pre_candidates)}
+    def rank_documents(self, doc_ids: set, news_entity_frequency: Counter,
+                       news_entities: set,
+                       scoring_type: str='intersection') -> list:
         if scoring_type == 'bm_25':
-            index_candidates_rank =\
-                [(doc_id,
-                  *self.calculate_document_rank(
+            return [
+                (doc_id, *self.calculate_document_rank(
                     news_entity_frequency,
                     self.index.db.get(doc_id)['entity_frequency'],
-                    self.index.db.get(doc_id)['text_len']
-                  )) for doc_id in index_candidates]
-        elif scoring_type == 'intersection':
-            index_candidates_rank = [
-                (doc_id, *self.calculate_intersection_rank(unique_news_entities,
+                    self.index.db.get(doc_id)['text_len']))
+                for doc_id in doc_ids
+            ]
+        if scoring_type == 'intersection':
+            return [
+                (doc_id, *self.calculate_intersection_rank(news_entities,
                                                            set(self.index.db.
                                                                get(doc_id)['entity'])))
-                for doc_id in index_candidates
+                for doc_id in doc_ids
             ]
+        raise ValueError(f"Unknown scoring type: {scoring_type}")
+
+    def get_document_ranking_by_paper(self, paper: Union[str, DocumentAnalysis],
+                                      scoring_type: str='intersection',
+                                      pre_candidates: Optional[dict]=None) -> list:
+        analysis = paper if isinstance(paper, DocumentAnalysis) \
+            else self.analyze(paper)
+        paper_entity_context = analysis.entity_context
+        news_entity_frequency = analysis.entity_frequency
+        unique_news_entities = set(paper_entity_context.keys())
+        index_response = self.index.lookup_query(unique_news_entities)
+        index_candidates = {doc_id
+                            for posting_list in index_response.values()
+                            for doc_id in posting_list.doc_ids.tolist()
+                            if (pre_candidates is None or
+                                doc_id in pre_candidates)}
+        if self.scoring_engine is not None:
+            # documents added after the engine was built (delta segment of
+            # a segmented_index.SegmentedIndex) are scored per document
+            engine_candidates = {doc_id for doc_id in index_candidates
+                                 if doc_id < self.scoring_engine.n_documents}
+            index_candidates_rank = self.scoring_engine.rank(engine_candidates,
+                                                             news_entity_frequency,
+                                                             scoring_type)
+            index_candidates_rank += self.rank_documents(
+                index_candidates - engine_candidates, news_entity_frequency,
+                unique_news_entities, scoring_type)
+        else:
+            index_candidates_rank = self.rank_documents(
+                index_candidates, news_entity_frequency,
+                unique_news_entities, scoring_type)
         return index_candidates_rank, paper_entity_context
 
     def prepare_candidates(self, candidates: List[List[dict]],
@@ -113,6 +139,11 @@ class TfidfSearch:
                 entity_info['score'] = candidate[2][entity]
                 entity_info['src_sentences'] = list(self.index.db.\
                     get(candidate[0])['entity_context'][entity])
+                entity_context_ids = self.index.db.get(candidate[0]).\
+                    get('entity_context_ids')
+                if entity_context_ids is not None:
+                    entity_info['src_sentence_ids'] =\
+                        list(entity_context_ids[entity])
                 entity_info['query_sentences'] =\
                     list(paper_entity_context[entity])
                 if 'entity' not in candidate_info:
@@ -123,12 +154,12 @@ class TfidfSearch:
             formated_candidates.append(candidate_info)
         return formated_candidates
 
-    def search(self, paper_text: str,
+    def search(self, paper: Union[str, DocumentAnalysis],
                scoring_type: str='intersection',
                k_top: int=10,
                pre_candidates: Optional[dict]=None):
         document_ranking_by_paper, paper_entity_context =\
-            self.get_document_ranking_by_paper(paper_text,
+            self.get_document_ranking_by_paper(paper,
                                                scoring_type,
                                                pre_candidates)
         document_ranking_by_paper_top =\
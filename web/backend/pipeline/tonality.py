@@ -0,0 +1,32 @@
+from typing import List
+
+from tqdm import tqdm
+
+from pipeline.models import registry
+
+
+def predict_tonality(texts: List[str], batch_size: int = 1024,
+                     k: int = 2) -> List[dict]:
+    """
+    Top k sentiment classes with their probabilities per text.
+    """
+    model = registry.get_sentiment_model()
+    tonality = []
+    for start in tqdm(range(0, len(texts), batch_size)):
+        tonality.extend(dict(prediction) for prediction in
+                        model.predict(texts[start:start + batch_size], k=k))
+    return tonality
+
+
+def add_tonality(documents: List[dict], batch_size: int = 1024,
+                 overwrite: bool = False) -> None:
+    """
+    Fills document['tonality'] of the documents that have none (of all of
+    them with overwrite), the model is run on whole batches of texts.
+    """
+    documents = [document for document in documents
+                 if overwrite or not document.get('tonality')]
+    tonality = predict_tonality([document['text'] for document in documents],
+                                batch_size)
+    for document, document_tonality in zip(documents, tonality):
+        document['tonality'] = document_tonality
@@ -0,0 +1,107 @@
+import argparse
+import copy
+import json
+import re
+import time
+import numpy as np
+import torch
+
+from pipeline.inference_backends import build_inference_backend, INFERENCE_BACKENDS
+from pipeline.models import registry, RUBERT_SENTENCE
+from pipeline.scorer import SentenceBertScorer
+
+
+def split_sentences(text: str) -> list:
+    return [sentence.strip() for sentence in re.split(r'[.!?…]', text)
+            if len(sentence.split()) > 2]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def validate(articles: list, backend: str, onnx_path: str = None,
+             model_name: str = RUBERT_SENTENCE) -> dict:
+    """
+    Compares the backend against float32 eager inference on held-out
+    articles: scorer score matrices of query (first half) vs source (second
+    half) sentences, the per-article scorer value and the semantic search
+    embedding of the full text.
+    """
+    embedder = registry.get_sentence_transformer(model_name)
+    model, tokenizer = registry.get_encoder(model_name)
+    backend_model, backend_encoder = build_inference_backend(
+        backend, copy.deepcopy(model), tokenizer, onnx_path, inplace=True)
+    if backend_encoder is None:
+        backend_encoder = copy.deepcopy(embedder)
+        backend_encoder[0].auto_model = backend_model.model
+    eager_scorer = SentenceBertScorer(model, tokenizer)
+    backend_scorer = SentenceBertScorer(backend_model, tokenizer)
+
+    matrix_drift, score_drift, embedding_similarity = [], [], []
+    eager_time, backend_time = 0, 0
+    for article in articles:
+        sentences = split_sentences(article['text'])
+        if len(sentences) < 2:
+            continue
+        query_sentences = sentences[:len(sentences) // 2]
+        src_sentences = sentences[len(sentences) // 2:]
+        eager_matrix, elapsed = timed(eager_scorer.get_score_matrix,
+                                      query_sentences, src_sentences)
+        eager_time += elapsed
+        backend_matrix, elapsed = timed(backend_scorer.get_score_matrix,
+                                        query_sentences, src_sentences)
+        backend_time += elapsed
+        matrix_drift.append((eager_matrix - backend_matrix).abs().max().item())
+        score_drift.append(abs((1 - eager_matrix).max().item() -
+                               (1 - backend_matrix).max().item()))
+        with torch.no_grad():
+            eager_embedding, elapsed = timed(
+                lambda text: embedder.encode(text, convert_to_tensor=True),
+                article['text'])
+            eager_time += elapsed
+            backend_embedding, elapsed = timed(
+                lambda text: backend_encoder.encode(text, convert_to_tensor=True),
+                article['text'])
+            backend_time += elapsed
+        embedding_similarity.append(torch.nn.functional.cosine_similarity(
+            eager_embedding, backend_embedding, dim=0).item())
+
+    return {
+        'backend': backend,
+        'articles': len(matrix_drift),
+        'score_matrix_max_abs_drift': float(np.max(matrix_drift)) if matrix_drift else None,
+        'score_matrix_mean_max_abs_drift': float(np.mean(matrix_drift)) if matrix_drift else None,
+        'article_score_mean_abs_drift': float(np.mean(score_drift)) if score_drift else None,
+        'embedding_min_cosine': float(np.min(embedding_similarity)) if embedding_similarity else None,
+        'eager_seconds': eager_time,
+        'backend_seconds': backend_time,
+        'speedup': eager_time / backend_time if backend_time else None,
+    }
+
+
+def main(articles_path: str, backend: str, n_articles: int, onnx_path: str):
+    with open(articles_path, "rt") as f:
+        articles = json.load(f)[-n_articles:]
+    report = validate(articles, backend, onnx_path)
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inference backend validation")
+    parser.add_argument("--articles", type=str, required=True,
+                        help="path to json with held-out parsed articles")
+    parser.add_argument("--backend", type=str, required=True,
+                        choices=[backend for backend in INFERENCE_BACKENDS
+                                 if backend != 'eager'])
+    parser.add_argument("--n-articles", type=int, default=100,
+                        help="number of articles taken from the end of the file")
+    parser.add_argument("--onnx-path", type=str, default=None,
+                        help="path of the exported onnx graph")
+
+    args = parser.parse_args()
+    main(articles_path=args.articles, backend=args.backend,
+         n_articles=args.n_articles, onnx_path=args.onnx_path)
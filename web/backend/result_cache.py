@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize('NFC', text).replace('\r\n', '\n').strip()
+
+
+class ResultCache:
+    """
+    /check results keyed by the hash of the normalized text and the index
+    version, so a new index never serves old results.
+    Two tiers: an in-process LRU and an optional sqlite file shared by the
+    workers of the host. Both expire entries after ttl seconds and keep at
+    most max_size of them.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 600,
+                 path: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # the sqlite tier has a lock of its own: a thread writing it never
+        # blocks the in-memory lookups of the event loop
+        self.db_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                                'key TEXT PRIMARY KEY, version TEXT, '
+                                'value BLOB, expires_at REAL)')
+                self.db.execute('CREATE INDEX IF NOT EXISTS results_expires_at '
+                                'ON results (expires_at)')
+
+    @classmethod
+    def from_env(cls) -> 'ResultCache':
+        return cls(max_size=int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+                   ttl=float(os.environ.get('RESULT_CACHE_TTL', 600)),
+                   path=os.environ.get('RESULT_CACHE_PATH') or None)
+
+    @staticmethod
+    def get_key(text: str, version: str) -> str:
+        return hashlib.sha256(
+            f'{version}\0{normalize_text(text)}'.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.get_memory(key)
+        if value is None and self.db is not None:
+            value = self.get_stored(key)
+        return self.count(value)
+
+    async def get_async(self, key: str) -> Optional[Any]:
+        """
+        get for the event loop: the sqlite tier is read in a thread.
+        """
+        value = self.get_memory(key)
+        if value is None and self.db is not None:
+            value = await asyncio.get_running_loop().run_in_executor(
+                None, self.get_stored, key)
+        return self.count(value)
+
+    def count(self, value: Optional[Any]) -> Optional[Any]:
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def get_memory(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at > now:
+                self.entries.move_to_end(key)
+                return value
+            del self.entries[key]
+        return None
+
+    def get_stored(self, key: str) -> Optional[Any]:
+        with self.db_lock:
+            row = self.db.execute('SELECT value, expires_at FROM results '
+                                  'WHERE key = ? AND expires_at > ?',
+                                  (key, time.time())).fetchone()
+        if row is None:
+            return None
+        value = pickle.loads(row[0])
+        with self.lock:
+            self._put_memory(key, value, row[1])
+        return value
+
+    def _put_memory(self, key: str, value: Any, expires_at: float) -> None:
+        self.entries[key] = (expires_at, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def put(self, key: str, value: Any, version: str) -> None:
+        expires_at = time.time() + self.ttl
+        with self.lock:
+            self._put_memory(key, value, expires_at)
+        if self.db is not None:
+            with self.db_lock, self.db:
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                                (key, version, pickle.dumps(value), expires_at))
+                # expired rows first, then the ones closest to expiry
+                self.db.execute('DELETE FROM results WHERE expires_at <= ?',
+                                (time.time(),))
+                self.db.execute('DELETE FROM results WHERE key IN ('
+                                'SELECT key FROM results ORDER BY expires_at DESC '
+                                'LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    async def put_async(self, key: str, value: Any, version: str) -> None:
+        """
+        put for the event loop: the sqlite tier is written in a thread.
+        """
+        if self.db is None:
+            return self.put(key, value, version)
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.put, key, value, version)
+
+    def invalidate(self, version: Optional[str] = None) -> None:
+        """
+        Drops the results of every index version except `version`.
+        """
+        with self.lock:
+            self.entries.clear()
+        if self.db is not None:
+            with self.db_lock, self.db:
+                self.db.execute('DELETE FROM results WHERE version IS NOT ?',
+                                (version,))
+
+    def close(self) -> None:
+        if self.db is not None:
+            with self.db_lock:
+                self.db.close()
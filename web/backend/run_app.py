@@ -1,8 +1,35 @@
 import uvicorn
 import os
 
+
+def run_preloaded(workers: int = 3):
+    """
+    Loads the models in the master process and forks the workers afterwards,
+    so they share the weights copy-on-write instead of loading a copy each.
+    """
+    from gunicorn.app.base import BaseApplication
+    from pipeline.models import registry
+
+    class PreloadedApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{os.environ['HOST']}:{os.environ['BACKEND_PORT']}")
+            self.cfg.set('workers', workers)
+            self.cfg.set('worker_class', 'uvicorn.workers.UvicornWorker')
+            self.cfg.set('preload_app', True)
+
+        def load(self):
+            from app import app
+            return app
+
+    registry.preload()
+    PreloadedApplication().run()
+
+
 if __name__ == '__main__':
-    uvicorn.run("app:app", host=os.environ['HOST'],
-                port=int(os.environ['BACKEND_PORT']),
-                reload=True, debug=True, workers=3,
-                )
+    if os.environ.get('PRELOAD_MODELS', '0') == '1':
+        run_preloaded()
+    else:
+        uvicorn.run("app:app", host=os.environ['HOST'],
+                    port=int(os.environ['BACKEND_PORT']),
+                    reload=True, debug=True, workers=3,
+                    )
@@ -1,8 +1,28 @@
-from dostoevsky.tokenization import RegexTokenizer
-from dostoevsky.models import FastTextSocialNetworkModel
+from typing import List
+
+from pipeline.batching import MicroBatcher
+from pipeline.models import registry
+
+model = registry.get_sentiment_model()
+batcher = None
+
+
+def predict_batch(texts: List[str]) -> List[dict]:
+    return model.predict(texts, k=2)
+
+
+def setup(micro_batching: bool = False, micro_batch_wait_ms: float = 5.0):
+    """
+    micro_batching: score the texts of concurrent requests in shared
+    batches, as the rubert encoders do.
+    """
+    global batcher
+    if micro_batching:
+        batcher = MicroBatcher(predict_batch, max_wait_ms=micro_batch_wait_ms,
+                               name='sentiment-batcher')
 
-tokenizer = RegexTokenizer()
-model = FastTextSocialNetworkModel(tokenizer=tokenizer)
 
 def predict(text:str):
-    return model.predict([text], k=2)[0]
\ No newline at end of file
+    if batcher is not None:
+        return batcher([text])[0]
+    return predict_batch([text])[0]